@@ -0,0 +1,140 @@
+'''
+Non-interactive batch driver for DistributeExposure.
+
+Runs every country x LOB x peril combination listed in a JSON job manifest,
+e.g.
+
+{
+    "geodatafilepath": "C:\\PF2\\QGIS Valmiera\\Datasets",
+    "image_file": "C:\\...\\F16_20100111-20110731_rad_v4.avg_vis.tif",
+    "jobs": [
+        {"countries": ["Belgium", "France"], "resolution": "State/Province",
+         "LOB": ["Res", "Com"], "peril": ["WS", "FL"],
+         "count": 1000, "avg_TIV": 250000, "update_lights": true},
+        {"countries": ["Bahamas"], "resolution": "Country",
+         "LOB": ["Res"], "peril": ["WS"], "count": 500, "avg_TIV": 300000},
+        {"countries": ["Brazil"], "resolution": "State/Province",
+         "LOB": ["Ind"], "peril": ["FL"], "portfolio": "C:\\...\\BrazilInd.csv"}
+    ]
+}
+
+An optional top-level "report_file" collects stage timing and memory of the
+whole batch as JSON lines (see StageLog). Optional job settings are passed through to Portfolio: workers, seed,
+strategy, realizations, output_format, memory_budget, weight_transform
+(e.g. [["threshold", 10], ["power", 1.5]]), pipeline (background table loading
+and output writing, see Pipeline). With "edm": true a job also
+writes EDM import files to <country>\\EDM (see EDMGenerator). Lights are clipped (update_lights)
+and sampling tables loaded once per country and resolution, then reused for
+all LOB/peril combinations. Failed jobs, including jobs that wrote no
+locations, are reported at the end without stopping the batch, as are jobs
+that skipped regions holding locations or TIV (unknown names, no lights).
+'''
+
+import argparse
+import json
+import os
+import traceback
+from root.nested.ClipLights import Clip, Portfolio
+from root.nested.SamplingTable import MEMORY_BUDGET
+from root.nested.StageLog import StageLog
+from root.nested import DistributeExposure
+
+# Job settings passed through to Portfolio
+PORTFOLIO_OPTIONS = ('workers', 'seed', 'strategy', 'realizations', 'output_format', 'memory_budget', 'weight_transform', 'pipeline')
+
+
+def expandJobs(manifest):
+    '''
+    Expand manifest entries into one job per country, LOB and peril,
+    grouped by country and resolution
+    '''
+    groups = {}
+    for entry in manifest['jobs']:
+        for country in entry['countries']:
+            for LOB in entry['LOB']:
+                for peril in entry['peril']:
+                    job = dict(entry)
+                    job.update(country=country, LOB=LOB, peril=peril)
+                    groups.setdefault((country, entry['resolution']), []).append(job)
+    return groups
+
+
+def outputFile(datapath, job):
+    # Separate compiled output per job, so LOB/peril runs do not overwrite each other
+    level = {'Country': 'Country', 'Postal Code': 'Postal'}.get(job['resolution'], 'Province')
+    return os.path.join(datapath, job['country'], 'Provinces', '%s%sPts_%s_%s.%s' % (job['country'], level, job['LOB'], job['peril'], job.get('output_format', 'csv')))
+
+
+def portfolioFile(datapath, job):
+    # Portfolio file, or equal exposure portfolio / country totals from count and average TIV
+    if job['resolution'] == 'Country':
+        return [job['country'], job['count'], job['count'] * job['avg_TIV']]
+    if 'portfolio' in job:
+        return os.path.abspath(job['portfolio'])
+    return DistributeExposure.equalExposureTestPortfolio(job['country'], job['count'], job['avg_TIV'], datapath)
+
+
+def runBatch(manifest):
+    '''
+    Run all jobs in a manifest (dict or path to .json file).
+    Returns list of (job, error) for jobs that failed or wrote no locations.
+    '''
+    if not isinstance(manifest, dict):
+        with open(manifest, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    # Manifest paths may be relative to the directory the batch is started from
+    datapath = os.path.abspath(manifest.get('geodatafilepath', DistributeExposure.geodatafilepath))
+    image_file = os.path.abspath(manifest['image_file'])
+    report_file = manifest.get('report_file')
+    log = StageLog(os.path.abspath(report_file) if report_file else None)
+
+    failed = []
+    incomplete = []
+    completed = 0
+    for (country, resolution), jobs in expandJobs(manifest).items():
+        # Clip lights once per country
+        if any(job.get('update_lights', False) for job in jobs):
+            try:
+                lights = Clip(country, image_file, resolution, datapath, workers=jobs[0].get('workers', 1),
+                             memory_budget=jobs[0].get('memory_budget', MEMORY_BUDGET), log=log)
+                lights.clipToMask()
+            except Exception:
+                error = traceback.format_exc()
+                failed.extend((job, error) for job in jobs)
+                continue
+
+        # Sampling tables loaded by the first portfolio are reused by the rest
+        tables = None
+        for job in jobs:
+            try:
+                options = dict((key, job[key]) for key in PORTFOLIO_OPTIONS if key in job)
+                if job.get('edm'):
+                    options['edm_directory'] = os.path.join(datapath, country, 'EDM')
+                portfolio = Portfolio(country, image_file, portfolioFile(datapath, job), resolution, job['LOB'], job['peril'], datapath,
+                                      output_file=outputFile(datapath, job), tables=tables, interactive=False, log=log, **options)
+                tables = portfolio.tables
+                locations, skipped = portfolio.distribute_locs()
+            except Exception:
+                failed.append((job, traceback.format_exc()))
+                continue
+            if locations == 0:
+                failed.append((job, 'No locations written, skipped regions: %s' % ', '.join(str(name) for name in skipped)))
+                continue
+            completed += 1
+            if skipped:
+                incomplete.append((job, skipped))
+
+    print('Completed %d jobs (%d with skipped regions), %d failed' % (completed, len(incomplete), len(failed)))
+    for job, skipped in incomplete:
+        print('Skipped regions: %s %s %s %s: %s' % (job['country'], job['resolution'], job['LOB'], job['peril'], ', '.join(str(name) for name in skipped)))
+    for job, error in failed:
+        print('Failed: %s %s %s %s' % (job['country'], job['resolution'], job['LOB'], job['peril']))
+        print(error)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run exposure disaggregation jobs from a manifest without user input')
+    parser.add_argument('manifest', help='JSON job manifest')
+    args = parser.parse_args()
+    runBatch(args.manifest)
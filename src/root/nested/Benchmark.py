@@ -0,0 +1,248 @@
+'''
+Synthetic benchmark of Clip and Portfolio.
+
+Generates a lights GeoTIFF and matching Natural Earth style boundary
+shapefiles (a rectangular country split into a grid of provinces) in a
+scratch directory, then clips the lights and disaggregates an equal exposure
+portfolio with each sampling strategy. Reports throughput (pixels/s for the
+clip and table stages, points/s for sampling and output) and peak memory per
+stage, from the StageLog report of each run. Runs offline, e.g.
+
+    python -m root.nested.Benchmark --size 8000 6000 --provinces 80 --lit 0.2
+        --locations 1000000 --strategy cdf multinomial tiled --json results.json
+
+Each case runs in a fresh process, so peak RSS is that of the case alone
+(worker processes started with --workers are not included).
+'''
+
+import argparse
+import concurrent.futures
+import json
+import os
+import tempfile
+import time
+from osgeo import gdal, ogr, osr
+gdal.UseExceptions()
+import numpy as np
+import pandas
+from root.nested.ClipLights import Clip, Portfolio
+from root.nested.Boundaries import boundaryCatalog, provinceShapefile, countryShapefile
+from root.nested.SamplingTable import SAMPLERS, MEMORY_BUDGET
+from root.nested.PointWriter import WRITERS
+from root.nested.StageLog import StageLog, readReport, memoryUsage
+
+COUNTRY = 'Synthetica'
+
+# NOAA stable lights grid: 30 arc-second pixels
+RESOLUTION = 30/3600.
+
+# Stages measured in pixels and in locations
+PIXEL_STAGES = ('mask', 'raster load', 'clip/rasterize', 'geotiff write', 'table build', 'table load')
+LOCATION_STAGES = ('sampling', 'TIV scaling', 'output write', 'merge')
+
+
+def makeLights(image_file, xsize, ysize, lit_fraction, geotransform, seed=0, rows=1024):
+    '''
+    Synthetic lights raster: lit_fraction of the pixels get a radiance of
+    1-63, lognormal like the stable lights. Written in row blocks.
+    '''
+    rng = np.random.default_rng(seed)
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(image_file, xsize, ysize, 1, gdal.GDT_Byte, options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    ds.SetGeoTransform(geotransform)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    for yoff in range(0, ysize, rows):
+        h = min(rows, ysize - yoff)
+        lit = rng.random((h, xsize)) < lit_fraction
+        values = np.clip(rng.lognormal(2., 1., (h, xsize)), 1, 63).astype(np.uint8)
+        band.WriteArray(np.where(lit, values, 0).astype(np.uint8), 0, yoff)
+    ds.FlushCache()
+    del band, ds
+
+
+def ring(x0, x1, y0, y1, vertices):
+    # Closed rectangle x0..x1, y0..y1 with each side split into vertices segments
+    t = np.linspace(0, 1, vertices, endpoint=False)
+    xs = np.concatenate((x0 + (x1-x0)*t, np.full(vertices, x1), x1 - (x1-x0)*t, np.full(vertices, x0)))
+    ys = np.concatenate((np.full(vertices, y1), y1 - (y1-y0)*t, np.full(vertices, y0), y0 + (y1-y0)*t))
+    return list(zip(xs, ys)) + [(xs[0], ys[0])]
+
+
+def gridProvinces(extent, provinces, vertices):
+    # About provinces rectangles covering extent in a grid, as (name, ring) pairs
+    minX, maxX, minY, maxY = extent
+    nx = max(int(round(np.sqrt(provinces * (maxX-minX) / (maxY-minY)))), 1)
+    ny = max(int(np.ceil(provinces / float(nx))), 1)
+    xs = np.linspace(minX, maxX, nx+1)
+    ys = np.linspace(maxY, minY, ny+1)
+    return [('P%04d' % (j*nx + i), ring(xs[i], xs[i+1], ys[j+1], ys[j], vertices)) for j in range(ny) for i in range(nx)]
+
+
+def writeShapefile(shp, features):
+    # Polygon shapefile with a name field, as Natural Earth boundaries
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if not os.path.exists(os.path.dirname(shp)):
+        os.makedirs(os.path.dirname(shp))
+    if os.path.exists('%s.shp' % shp):
+        driver.DeleteDataSource('%s.shp' % shp)
+    ds = driver.CreateDataSource('%s.shp' % shp)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    layer = ds.CreateLayer(os.path.basename(shp), srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+    for name, points in features:
+        outline = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in points:
+            outline.AddPoint_2D(float(x), float(y))
+        poly = ogr.Geometry(ogr.wkbPolygon)
+        poly.AddGeometry(outline)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('name', name)
+        feature.SetGeometry(poly)
+        layer.CreateFeature(feature)
+    del layer, ds
+
+
+def makeDataset(datapath, xsize, ysize, provinces, lit_fraction, vertices=50, seed=0):
+    '''
+    Lights raster and boundary shapefiles of the synthetic country under
+    datapath, reused if already generated with the same parameters.
+    Returns the lights image file.
+    '''
+    image_file = os.path.join(datapath, 'Night Lights', '%sLights.tif' % COUNTRY)
+    params_file = os.path.join(datapath, 'Night Lights', '%sLights.json' % COUNTRY)
+    params = {'size': [xsize, ysize], 'provinces': provinces, 'lit': lit_fraction, 'vertices': vertices, 'seed': seed}
+    if os.path.exists(params_file) and os.path.exists(image_file):
+        with open(params_file, 'r') as paramsfile:
+            if json.load(paramsfile) == params:
+                return image_file
+    if not os.path.exists(os.path.dirname(image_file)):
+        os.makedirs(os.path.dirname(image_file))
+
+    geotransform = (10., RESOLUTION, 0., 50., 0., -RESOLUTION)
+    makeLights(image_file, xsize, ysize, lit_fraction, geotransform, seed)
+
+    # Country inside the raster, so the country window is clipped out of it
+    margin = 0.02
+    extent = (geotransform[0] + xsize*RESOLUTION*margin, geotransform[0] + xsize*RESOLUTION*(1-margin),
+              geotransform[3] - ysize*RESOLUTION*(1-margin), geotransform[3] - ysize*RESOLUTION*margin)
+    writeShapefile(countryShapefile(datapath, COUNTRY), [(COUNTRY, ring(extent[0], extent[1], extent[2], extent[3], vertices))])
+    writeShapefile(provinceShapefile(datapath, COUNTRY), gridProvinces(extent, provinces, vertices))
+
+    with open(params_file, 'w') as paramsfile:
+        json.dump(params, paramsfile)
+    return image_file
+
+
+def clipCase(datapath, image_file, resolution, workers, memory_budget, report_file, run):
+    # Clip lights and build sampling tables, in a fresh process
+    log = StageLog(report_file, run)
+    with log.stage('clip total'):
+        lights = Clip(COUNTRY, image_file, resolution, datapath, workers=workers, memory_budget=memory_budget, log=log)
+        lights.clipToMask()
+    return memoryUsage()[1]
+
+
+def portfolioCase(datapath, image_file, resolution, locations, strategy, output_format, realizations, workers, memory_budget, report_file, run, seed, pipeline=False):
+    # Disaggregate an equal exposure portfolio with one sampling strategy, in a fresh process
+    if resolution == 'Country':
+        portfolio_file = [COUNTRY, locations, locations * 250000.]
+    else:
+        names = boundaryCatalog(provinceShapefile(datapath, COUNTRY), datapath, COUNTRY).names()
+        count = max(locations // len(names), 1)
+        portfolio_file = pandas.DataFrame({'name': names, 'locCount': count, 'locTIV': count * 250000.})
+    log = StageLog(report_file, run)
+    output_file = os.path.join(datapath, COUNTRY, 'Provinces', 'Benchmark_%s.%s' % (run, output_format))
+    with log.stage('portfolio total', locations=locations*realizations):
+        portfolio = Portfolio(COUNTRY, image_file, portfolio_file, resolution, 'Res', 'WS', datapath, workers=workers, seed=seed,
+                              strategy=strategy, realizations=realizations, output_file=output_file, output_format=output_format,
+                              interactive=False, memory_budget=memory_budget, pipeline=pipeline, log=log)
+        portfolio.distribute_locs()
+    os.remove(output_file)
+    return memoryUsage()[1]
+
+
+def inProcess(function, *args):
+    # Run one case in a new process and return its result
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(function, *args).result()
+
+
+def stageThroughput(report_file, run, case, peak_rss):
+    '''
+    Seconds and throughput of each stage of one run, one row per stage
+    '''
+    frame = readReport(report_file, run)
+    rows = []
+    for stage, records in frame.groupby('stage', sort=False):
+        seconds = records['seconds'].sum()
+        row = {'case': case, 'stage': stage, 'seconds': seconds, 'peak_rss_mb': records['peak_rss'].max() / 1024.**2}
+        if stage in PIXEL_STAGES and 'pixels' in records:
+            row['pixels/s'] = records['pixels'].sum() / seconds if seconds else np.nan
+        if (stage in LOCATION_STAGES or stage == 'portfolio total') and 'locations' in records:
+            row['points/s'] = records['locations'].sum() / seconds if seconds else np.nan
+        rows.append(row)
+    rows.append({'case': case, 'stage': 'process peak', 'peak_rss_mb': peak_rss / 1024.**2 if peak_rss else np.nan})
+    return rows
+
+
+def runBenchmark(datapath, size=(4000, 3000), provinces=50, lit_fraction=0.2, vertices=50, locations=100000,
+                 strategies=('cdf', 'multinomial', 'tiled'), output_format='csv', realizations=1, resolution='State/Province',
+                 workers=1, memory_budget=MEMORY_BUDGET, seed=0, pipeline=False):
+    '''
+    Generate the synthetic dataset, clip it once, then disaggregate with each
+    strategy. Returns a DataFrame of stage timings and throughput.
+    '''
+    # Keep paths absolute
+    datapath = os.path.abspath(datapath)
+    image_file = makeDataset(datapath, size[0], size[1], provinces, lit_fraction, vertices, seed)
+    report_file = os.path.join(datapath, 'BenchmarkReport.jsonl')
+    if os.path.exists(report_file):
+        os.remove(report_file)
+
+    rows = []
+    peak_rss = inProcess(clipCase, datapath, image_file, resolution, workers, memory_budget, report_file, 'clip')
+    rows.extend(stageThroughput(report_file, 'clip', 'clip', peak_rss))
+    for strategy in strategies:
+        peak_rss = inProcess(portfolioCase, datapath, image_file, resolution, locations, strategy, output_format, realizations,
+                             workers, memory_budget, report_file, strategy, seed, pipeline)
+        rows.extend(stageThroughput(report_file, strategy, 'sample %s' % strategy, peak_rss))
+    return pandas.DataFrame(rows, columns=['case', 'stage', 'seconds', 'pixels/s', 'points/s', 'peak_rss_mb'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark clipping and disaggregation on synthetic data')
+    parser.add_argument('--datapath', help='Scratch directory for the synthetic dataset, reused between runs (default: temporary)')
+    parser.add_argument('--size', type=int, nargs=2, default=[4000, 3000], metavar=('XSIZE', 'YSIZE'), help='Lights raster size in pixels')
+    parser.add_argument('--provinces', type=int, default=50)
+    parser.add_argument('--lit', type=float, default=0.2, help='Fraction of lit pixels')
+    parser.add_argument('--vertices', type=int, default=50, help='Vertices per province side')
+    parser.add_argument('--locations', type=int, default=100000, help='Locations in the portfolio')
+    parser.add_argument('--realizations', type=int, default=1)
+    parser.add_argument('--strategy', nargs='+', default=sorted(SAMPLERS), choices=sorted(SAMPLERS))
+    parser.add_argument('--output-format', default='csv', choices=sorted(WRITERS))
+    parser.add_argument('--resolution', default='State/Province', choices=['Country', 'State/Province'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--memory-budget', type=int, default=MEMORY_BUDGET)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pipeline', action='store_true', help='Overlap table loading and output writing with sampling')
+    parser.add_argument('--json', help='Also save results to this file, to compare releases')
+    args = parser.parse_args()
+
+    def run(datapath):
+        start = time.perf_counter()
+        results = runBenchmark(datapath, args.size, args.provinces, args.lit, args.vertices, args.locations, args.strategy,
+                               args.output_format, args.realizations, args.resolution, args.workers, args.memory_budget, args.seed, args.pipeline)
+        print(results.to_string(index=False, float_format=lambda x: '%.4g' % x))
+        print('Total %.1f s' % (time.perf_counter() - start))
+        if args.json:
+            results.to_json(args.json, orient='records', indent=1)
+
+    if args.datapath:
+        run(args.datapath)
+    else:
+        with tempfile.TemporaryDirectory() as datapath:
+            run(datapath)
@@ -0,0 +1,220 @@
+'''
+Boundary catalog: province names, feature ids, envelopes and geometries of a
+Natural Earth boundary shapefile, read once per country and shared by Clip,
+Portfolio and the equal exposure test portfolio.
+
+Also matching of portfolio province names to boundary names, with a
+persisted per-country alias table.
+'''
+
+from osgeo import ogr
+import collections
+import difflib
+import json
+import os
+import pickle
+import re
+import threading
+import unicodedata
+from root.nested.SamplingTable import fileStamp
+
+# Catalogs already loaded in this process, by shapefile
+_catalogs = {}
+
+
+class BoundaryCatalog(object):
+    '''
+    Maps province name to feature id, envelope and geometry (as WKB).
+    Optionally persisted to cache_file, so later runs skip the OGR reads.
+    Features sharing a name are merged into one geometry.
+    '''
+
+    def __init__(self, shp, cache_file=None):
+        self.shp = shp
+        self.stamp = [fileStamp('%s.shp' % shp), fileStamp('%s.dbf' % shp)]
+        self.features = None
+
+        if cache_file is not None:
+            self.features = self.loadCache(cache_file)
+        if self.features is None:
+            self.features = self.readShapefile()
+            if cache_file is not None:
+                self.saveCache(cache_file)
+
+    def readShapefile(self):
+        # Single pass over the layer
+        DriverName = "ESRI Shapefile"
+        driver = ogr.GetDriverByName(DriverName)
+        shapef = driver.Open('%s.shp' % self.shp)
+        lyr = shapef.GetLayer()
+
+        features = collections.OrderedDict()
+        for feature in lyr:
+            name = feature.GetField('name')
+            geom = feature.GetGeometryRef().Clone()
+            if name in features:
+                geom = geom.Union(ogr.CreateGeometryFromWkb(features[name][2]))
+            features[name] = (feature.GetFID(), geom.GetEnvelope(), bytes(geom.ExportToWkb()))
+        return features
+
+    def loadCache(self, cache_file):
+        # Cached features, or None if missing or written for a different shapefile version
+        try:
+            with open(cache_file, 'rb') as catalog_file:
+                stamp, features = pickle.load(catalog_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if stamp != self.stamp:
+            return None
+        return features
+
+    def saveCache(self, cache_file):
+        directory = os.path.dirname(cache_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(cache_file, 'wb') as catalog_file:
+            pickle.dump((self.stamp, self.features), catalog_file)
+
+    def names(self):
+        # Province names, excluding unnamed features
+        return [name for name in self.features if name != 'NULL']
+
+    def __contains__(self, name):
+        return name in self.features
+
+    def fid(self, name):
+        return self.features[name][0]
+
+    def envelope(self, name):
+        # minX, maxX, minY, maxY
+        return self.features[name][1]
+
+    def wkb(self, name):
+        return self.features[name][2]
+
+    def geometry(self, name):
+        return ogr.CreateGeometryFromWkb(self.features[name][2])
+
+
+def boundaryCatalog(shp, geodatafilepath, country):
+    '''
+    Shared catalog of a country's boundary shapefile, cached on disk in the country directory
+    '''
+    catalog = _catalogs.get(shp)
+    if catalog is None or catalog.stamp != [fileStamp('%s.shp' % shp), fileStamp('%s.dbf' % shp)]:
+        cache_file = os.path.join(geodatafilepath, country, '%s.catalog' % os.path.basename(shp))
+        catalog = _catalogs[shp] = BoundaryCatalog(shp, cache_file)
+    return catalog
+
+
+def provinceShapefile(geodatafilepath, country):
+    # Natural Earth state/province boundaries of a country, without extension
+    return os.path.join(geodatafilepath, 'Boundaries', 'ne_10m_admin_1_states_provinces', 'Separated by countries',
+                        'ne_10m_admin_1_states_provinces_admin__%s' % country)
+
+
+def countryShapefile(geodatafilepath, country):
+    # Natural Earth country boundary, without extension
+    return os.path.join(geodatafilepath, 'Boundaries', 'ne_10m_admin_0_countries', 'Separated by countries',
+                        'ne_10m_admin_0_countries_ADMIN__%s' % country)
+
+
+def postalShapefile(geodatafilepath, country):
+    # Postal code polygons of a country, without extension (see PostalZones)
+    return os.path.join(geodatafilepath, country, '%sPostalCodes' % country)
+
+
+def exclusionShapefiles(geodatafilepath, country):
+    '''
+    Water and uninhabitable area polygons masked out of the lights: Natural
+    Earth lakes and reservoirs, plus optional country-specific exclusions
+    (small water bodies, parks, ...) saved as <country>/<country>Exclusions.shp.
+    Missing files are skipped.
+    '''
+    return [os.path.join(geodatafilepath, 'Boundaries', 'ne_10m_lakes', 'ne_10m_lakes'),
+            os.path.join(geodatafilepath, country, '%sExclusions' % country)]
+
+
+def normalizeName(name):
+    # Accent-folded, lower case name with punctuation collapsed to single spaces
+    name = unicodedata.normalize('NFKD', str(name))
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return re.sub(r'[^a-z0-9]+', ' ', name.lower()).strip()
+
+
+class NameMatcher(object):
+    '''
+    Match portfolio province names to boundary names without user input:
+    exact name, alias table, normalized name, then fuzzy similarity of
+    normalized names. Only normalized matches and names confirmed by the
+    user are saved to the alias file and reused on later runs. Fuzzy matches
+    are accepted for this run only when nearly identical (score >= accept)
+    and clearly ahead of the runner-up; anything else is left to the user
+    (e.g. "Main" is not taken for "Maine"). An alias of 'None' drops the
+    province.
+    '''
+
+    def __init__(self, shp_names, alias_file=None, cutoff=0.8, accept=0.95):
+        self.names = set(shp_names)
+        self.alias_file = alias_file
+        self.cutoff = cutoff
+        self.accept = accept
+
+        # Normalized name -> boundary names, index for fuzzy lookups
+        self.normalized = {}
+        for name in shp_names:
+            self.normalized.setdefault(normalizeName(name), []).append(name)
+        self.keys = list(self.normalized)
+
+        self.aliases = {}
+        if alias_file is not None and os.path.exists(alias_file):
+            with open(alias_file, 'r', encoding='utf-8') as aliasfile:
+                self.aliases = json.load(aliasfile)
+        self.changed = False
+
+    def match(self, name):
+        '''
+        Returns (boundary name, candidates). Boundary name is None if the
+        match is ambiguous or missing, candidates are the closest names.
+        '''
+        if name in self.names:
+            return name, [name]
+        if name in self.aliases:
+            return self.aliases[name], [self.aliases[name]]
+
+        key = normalizeName(name)
+        candidates = self.normalized.get(key, [])
+        if len(candidates) == 1:
+            self.confirm(name, candidates[0])
+            return candidates[0], candidates
+        if candidates: # Same normalized name for several boundaries
+            return None, candidates
+
+        # Fuzzy match, accepted only if nearly identical and clearly better than the
+        # runner-up. Not saved as an alias, a guess is never reused without confirmation.
+        scores = []
+        for close in difflib.get_close_matches(key, self.keys, n=3, cutoff=self.cutoff):
+            scores.append((difflib.SequenceMatcher(None, key, close).ratio(), close))
+        candidates = [shp_name for score, close in scores for shp_name in self.normalized[close]]
+        if scores and scores[0][0] >= self.accept and len(self.normalized[scores[0][1]]) == 1 and \
+                (len(scores) == 1 or scores[0][0] - scores[1][0] >= 0.1):
+            return candidates[0], candidates
+        return None, candidates
+
+    def confirm(self, name, shp_name):
+        # Record a mapping for later runs
+        self.aliases[name] = shp_name
+        self.changed = True
+
+    def save(self):
+        if self.alias_file is None or not self.changed:
+            return
+        directory = os.path.dirname(self.alias_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Written aside and swapped in, so concurrent matchers (e.g. service requests) never read a partial file
+        temp_file = '%s.%d.%d.tmp' % (self.alias_file, os.getpid(), threading.get_ident())
+        with open(temp_file, 'w', encoding='utf-8') as aliasfile:
+            json.dump(self.aliases, aliasfile, indent=1, sort_keys=True, ensure_ascii=False)
+        os.replace(temp_file, self.alias_file)
+        self.changed = False
@@ -6,16 +6,32 @@ Created on Apr 8, 2014
 Modified from http://pcjericks.github.io/py-gdalogr-cookbook/layers.html
 '''
 
-from osgeo import gdal, gdalnumeric, ogr
+from osgeo import gdal, ogr
 from PIL import Image, ImageDraw
 gdal.UseExceptions()
 import numpy as np
 import pandas
-import bisect
 import os
-import sys
-import random
+import json
+import time
+import collections
+import concurrent.futures
+import functools
 import tkinter
+from root.nested.SamplingTable import TableStore, TableBuilder, tableKey, tileSize, tiles, fileStamp, SAMPLERS, WEIGHT_TRANSFORMS, LOB_TRANSFORMS, MEMORY_BUDGET, TABLE_VERSION
+from root.nested.PointWriter import WRITERS
+from root.nested.Boundaries import boundaryCatalog, provinceShapefile, countryShapefile, postalShapefile, exclusionShapefiles, NameMatcher
+from root.nested.PostalZones import PostalZones, BATCH_LOCATIONS
+from root.nested.EDMGenerator import EDM
+from root.nested.Pipeline import prefetch, BackgroundWriter
+from root.nested.PortfolioReader import readPortfolio, aggregateChunk, portfolioTotals
+from root.nested.StageLog import StageLog
+
+
+# Reserved file and table names of country-level clips, so a province named after
+# its country (Guatemala, Belize, Luxembourg, ...) never overwrites them
+COUNTRY_CLIP = '%sCountryClip' # Unmasked country window, source of the province pass
+COUNTRY_REGION = '%sCountry' # Masked country clip sampled at Country and Postal Code resolution
 
 
 class Clip(object):
@@ -23,7 +39,7 @@ class Clip(object):
     Takes input of country, splits nighttime lights dataset by province
     '''
     
-    def __init__(self, country, image_file, resolution, geodatafilepath):
+    def __init__(self, country, image_file, resolution, geodatafilepath, workers=1, memory_budget=MEMORY_BUDGET, log=None):
         '''
         Constructor
         '''
@@ -31,29 +47,55 @@ class Clip(object):
         
         # Raster image to clip\
         self.raster = image_file
+        self.resolution = resolution
+        self.country = country
+        self.geodatafilepath = geodatafilepath
+        
+        # Number of worker processes for province clipping
+        self.workers = workers
+        
+        # Rasters are read and clipped in square tiles sized to the memory budget (bytes),
+        # shared by the tiles in flight, one per worker
+        self.tile_size = tileSize(memory_budget // max(workers, 1))
+        
+        # Stage timing and memory report, see StageLog
+        if log is None:
+            log = StageLog()
+        self.log = log.bind(country=country, resolution=resolution)
         
         # Polygon shapefile used to clip
         if resolution == 'State/Province':
-            self.shp = r'%s\Boundaries\ne_10m_admin_1_states_provinces\Separated by countries\ne_10m_admin_1_states_provinces_admin__%s' % (geodatafilepath, country)
-            self.countryshp = r'%s\Boundaries\ne_10m_admin_0_countries\Separated by countries\ne_10m_admin_0_countries_ADMIN__%s' % (geodatafilepath, country)
-        elif resolution == 'Country':
-            self.shp = r'%s\Boundaries\ne_10m_admin_0_countries\Separated by countries\ne_10m_admin_0_countries_ADMIN__%s' % (geodatafilepath, country)
+            self.shp = provinceShapefile(geodatafilepath, country)
+            self.countryshp = countryShapefile(geodatafilepath, country)
+            shapefiles = [self.shp, self.countryshp]
+        elif resolution in ('Country', 'Postal Code'):
+            self.shp = countryShapefile(geodatafilepath, country)
+            shapefiles = [self.shp]
+        
+        # Water and uninhabitable areas removed from the lights
+        self.exclusions = exclusionShapefiles(geodatafilepath, country)
+        shapefiles = shapefiles + self.exclusions
         
+        # Postal code zones, rasterized on the same grid by 'Postal Code' clips only. Other
+        # resolutions tag points with the zones if they have been built.
+        self.postal = PostalZones(geodatafilepath, country, postalShapefile(geodatafilepath, country))
+        if resolution == 'Postal Code':
+            shapefiles = shapefiles + [self.postal.shp]
         
         # Name of clip raster file(s)
-        self.output = r'%s\%s\Provinces\Clip\\' % (geodatafilepath, country)
+        self.output = os.path.join(geodatafilepath, country, 'Provinces', 'Clip')
         
-        # Load the source data as a gdalnumeric array
-        self.srcArray = gdalnumeric.LoadFile(self.raster)
+        # Sampling tables derived while clipping, same cache Portfolio reads from
+        self.tables = TableStore(os.path.join(self.output, 'Tables'), tableKey(image_file, shapefiles, resolution), tile_size=self.tile_size)
         
-        # Also load as a gdal image to get geotransform
-        # (world file) info
+        # Open as a gdal image to get geotransform (world file) info.
+        # Pixel data is read per tile, so neither the global nor the
+        # country-level raster is ever loaded into memory whole.
         self.srcImage = gdal.Open(self.raster)
         
         if resolution == 'State/Province':
             # Apply initial clip to work with country-level raster, instead of global (improves speed)
             self.raster = self.initialClip()
-            self.srcArray = gdalnumeric.LoadFile(self.raster)
             self.srcImage = gdal.Open(self.raster)
             
         # Output resolution to .csv
@@ -65,137 +107,326 @@ class Clip(object):
         res = pandas.DataFrame(res_array, columns=('XRes','YRes'))
         
         # Start country directory if it doesn't already exist
-        if not os.path.exists('%s\%s' % (geodatafilepath, country)):
-            os.mkdir('%s\%s' % (geodatafilepath, country))
-        res.to_csv('%s\%s\%sResolution.csv' % (geodatafilepath, country, country),columns=('XRes','YRes'),index=False)
+        if not os.path.exists(os.path.join(geodatafilepath, country)):
+            os.makedirs(os.path.join(geodatafilepath, country))
+        res.to_csv(os.path.join(geodatafilepath, country, '%sResolution.csv' % country),columns=('XRes','YRes'),index=False)
         
-    def initialClip(self, shapef=None, lyr=None, openfile=True):
-        DriverName = "ESRI Shapefile"
-        driver = ogr.GetDriverByName(DriverName)
+    def initialClip(self):
+        # Clip source raster to the country boundary
+        catalog = boundaryCatalog(self.countryshp, self.geodatafilepath, self.country)
+        country_name = catalog.names()[0]
+        return self.clipTiled([country_name], [catalog.wkb(country_name)], self.window(catalog.envelope(country_name)), tables=False,
+                              files=[COUNTRY_CLIP % self.country])[0]
+    
+    def window(self, envelope):
+        '''
+        Pixel window (xoff, yoff, width, height) of an envelope in the source
+        image, trimmed to the raster extent
+        '''
+        minX, maxX, minY, maxY = envelope
+        geoTrans = self.srcImage.GetGeoTransform()
+        ulX, ulY = self.world2Pixel(geoTrans, minX, maxY)
+        lrX, lrY = self.world2Pixel(geoTrans, maxX, minY)
         
-        if openfile:
-            # Create an OGR layer from a boundary shapefile            
-            shapef = driver.Open('%s.shp' % self.countryshp)
-            lyr = shapef.GetLayer()
+        # Correction for countries that exceed satellite dataset boundaries
+        xoff = int(min(max(ulX, 0), self.srcImage.RasterXSize - 1))
+        yoff = int(min(max(ulY, 0), self.srcImage.RasterYSize - 1))
+        xend = int(min(max(lrX, xoff + 1), self.srcImage.RasterXSize))
+        yend = int(min(max(lrY, yoff + 1), self.srcImage.RasterYSize))
+        return xoff, yoff, xend - xoff, yend - yoff
         
-        geoTrans = self.srcImage.GetGeoTransform() 
-        poly = lyr.GetNextFeature()     
+    def clipToMask(self):
+        '''
+        Clip raster image using shapefile outlines of provinces.
+        Save results to geotiff - compatible with QGIS
+        '''
+        # Province outlines from the boundary catalog
+        catalog = boundaryCatalog(self.shp, self.geodatafilepath, self.country)
+        names = catalog.names()
+        wkbs = [catalog.wkb(province_name) for province_name in names]
         
-            
-        minX, maxX, minY, maxY = poly.GetGeometryRef().GetEnvelope()
-
+        if self.resolution == 'State/Province':
+            # Provinces cover the country-level raster
+            window = (0, 0, self.srcImage.RasterXSize, self.srcImage.RasterYSize)
+            files = None
+        else:
+            # Country-level clip is a single window of the global raster
+            window = self.window(catalog.envelope(names[0]))
+            files = [COUNTRY_REGION % self.country]
+        with self.log.stage('mask'):
+            mask_file = self.exclusionMask(window)
+        self.clipTiled(names, wkbs, window, mask_file=mask_file, files=files)
+        
+        if self.resolution == 'Postal Code':
+            if not os.path.exists('%s.shp' % self.postal.shp):
+                raise ValueError('No postal code shapefile for %s: %s.shp' % (self.country, self.postal.shp))
+            self.postal.build(self, window, mask_file)
+    
+    def windowTransform(self, window):
+        # Geotransform of a pixel window of the source image
+        return self.offsetTransform(self.srcImage.GetGeoTransform(), window[0], window[1])
+    
+    def offsetTransform(self, geoTrans, xoff, yoff):
+        # Geotransform of a raster starting xoff, yoff pixels into another
+        geoTrans = list(geoTrans)
+        geoTrans[0] += xoff * geoTrans[1]
+        geoTrans[3] += yoff * geoTrans[5]
+        return geoTrans
+    
+    def pixelBox(self, geoTrans, envelope, xsize, ysize):
+        # Pixel box (x, y, width, height) of an envelope, trimmed to an xsize x ysize raster
+        minX, maxX, minY, maxY = envelope
         ulX, ulY = self.world2Pixel(geoTrans, minX, maxY)
         lrX, lrY = self.world2Pixel(geoTrans, maxX, minY)
-        
-        # Include offset to position correctly within overall image
-        xoffset =  ulX
-        yoffset =  ulY
-        
-        # Correction for countries that exceed satellite dataset boundaries
-        if ulY < 0:
-            ulY = 0
-            yoffset = 0
-            maxY = 75.
+        x0 = int(min(max(ulX, 0), xsize - 1))
+        y0 = int(min(max(ulY, 0), ysize - 1))
+        return x0, y0, int(min(max(lrX + 1, x0 + 1), xsize)) - x0, int(min(max(lrY + 1, y0 + 1), ysize)) - y0
+    
+    def overlaps(self, box, tile):
+        bx, by, bw, bh = box
+        tx, ty, tw, th = tile
+        return bx < tx+tw and tx < bx+bw and by < ty+th and ty < by+bh
     
-        # Calculate the pixel size of the new image
-        pxWidth = int(lrX - ulX)
-        pxHeight = int(lrY - ulY)
+    def exclusionMask(self, window):
+        '''
+        Bitmask of water and uninhabitable areas over a window of the source
+        image, aligned with the clipped lights. Rasterized once per country and
+        cached as a 1-bit geotiff, rebuilt only if the exclusion shapefiles
+        change. Returns the mask file, or None if nothing is excluded.
+        '''
+        xoff, yoff, xsize, ysize = window
+        geoTrans = self.windowTransform(window)
+        mask_file = os.path.join(self.geodatafilepath, self.country, '%sMask.tif' % self.country)
+        meta_file = os.path.join(self.geodatafilepath, self.country, '%sMask.json' % self.country)
+        key = [TABLE_VERSION, geoTrans, xsize, ysize]
+        for shp in self.exclusions:
+            key.extend([fileStamp('%s.shp' % shp), fileStamp('%s.dbf' % shp)])
+        key = json.loads(json.dumps(key))
         
-        clip = self.srcArray[ulY:lrY, ulX:lrX]              
+        try:
+            with open(meta_file, 'r') as metafile:
+                meta = json.load(metafile)
+            if meta['key'] == key:
+                return meta['file']
+        except (OSError, ValueError, KeyError):
+            pass
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
         
-        # Create a new geomatrix for the image
-        geoTrans = list(geoTrans)
-        geoTrans[0] = minX
-        geoTrans[3] = maxY  
+        # Exclusion polygons overlapping the window
+        xmin, ymax = geoTrans[0], geoTrans[3]
+        xmax, ymin = xmin + xsize*geoTrans[1], ymax + ysize*geoTrans[5]
+        geoms = []
+        driver = ogr.GetDriverByName("ESRI Shapefile")
+        for shp in self.exclusions:
+            if not os.path.exists('%s.shp' % shp):
+                continue
+            shapef = driver.Open('%s.shp' % shp)
+            lyr = shapef.GetLayer()
+            lyr.SetSpatialFilterRect(xmin, ymin, xmax, ymax)
+            for feature in lyr:
+                geom = feature.GetGeometryRef()
+                if geom is not None and geom.GetGeometryName() in ('POLYGON', 'MULTIPOLYGON'):
+                    geoms.append(geom.Clone())
         
-        # Create new mask image for each province
-        rasterPoly = Image.new("L", (pxWidth, pxHeight), 1)  
+        mask = None
+        if geoms:
+            # Burn tile by tile; blocks without exclusions are never written
+            boxes = [self.pixelBox(geoTrans, geom.GetEnvelope(), xsize, ysize) for geom in geoms]
+            gtiffDriver = gdal.GetDriverByName( 'GTiff' )
+            ds = gtiffDriver.Create(mask_file, xsize, ysize, 1, gdal.GDT_Byte, options=['NBITS=1', 'COMPRESS=DEFLATE', 'SPARSE_OK=TRUE'])
+            ds.SetGeoTransform(geoTrans)
+            ds.SetProjection(self.srcImage.GetProjection())
+            band = ds.GetRasterBand(1)
+            for tile in tiles(xsize, ysize, self.tile_size):
+                tx, ty, tw, th = tile
+                inside = [geoms[k] for k, box in enumerate(boxes) if self.overlaps(box, tile)]
+                if not inside:
+                    continue
+                excluded = self.rasterizeLabels(inside, [1]*len(inside), self.offsetTransform(geoTrans, tx, ty), (tw, th)) > 0
+                band.WriteArray(excluded.astype(np.uint8), tx, ty)
+            ds.FlushCache()
+            del band, ds
+            mask = mask_file
         
-        geom = poly.GetGeometryRef()
+        # Metadata is written last, so an interrupted build is redone
+        with open(meta_file, 'w') as metafile:
+            json.dump({'key': key, 'file': mask}, metafile)
+        return mask
+    
+    def clipTiled(self, names, wkbs, window, tables=True, mask_file=None, files=None):
+        '''
+        Clip polygons (as WKB) out of a window of the source image, one tile at a
+        time, so peak memory depends on the tile size and not the window size.
+        Each polygon is saved as <name>.tif covering its envelope (or under files,
+        one name per polygon), and with tables its lit pixels are saved as a
+        sampling table of the same name indexed on the window.
+        Pixels set in mask_file (see exclusionMask) are dropped.
+        Returns the geotiff file names.
+        '''
+        xoff, yoff, xsize, ysize = window
+        geoTrans = self.windowTransform(window)
         
-        for ring in range(geom.GetGeometryCount()):
-            points = []
-            pixels = []
-            geom_poly = geom.GetGeometryRef(ring)
-            
-            # If picking the feature gets a polygon, there are islands, 
-            # go down another level to get LINEARRING
-            if geom_poly.GetGeometryName() == "POLYGON":
-                pts = geom_poly.GetGeometryRef(0)
-            else:
-                pts = geom.GetGeometryRef(0)
-            for p in range(pts.GetPointCount()):
-                points.append((pts.GetX(p), pts.GetY(p)))
-            for p in points:
-                pixels.append(self.world2Pixel(geoTrans, p[0], p[1]))
-            
-            rasterize = ImageDraw.Draw(rasterPoly)
-            rasterize.polygon(pixels, 0)
-            
-            mask = self.imageToArray(rasterPoly) 
-            
-            
-        # Clip the image using the mask
-        try:
-            clip = gdalnumeric.choose(mask, \
-                (clip, 0)).astype(gdalnumeric.uint32)
-        except:
-            print('%s exceeds the boundaries of the satellite dataset' % poly.GetField('name'))
-            sys.exit()
-            
-        # Save clipped province image   
-        province_name = poly.GetField('name')           
         gtiffDriver = gdal.GetDriverByName( 'GTiff' )
         if gtiffDriver is None:
             raise ValueError("Can't find GeoTiff Driver")
         if not os.path.exists(self.output):
             os.makedirs(self.output)
-        gtiffDriver.CreateCopy( "%s%s.tif" % (self.output, province_name),
-            self.OpenArray( clip, prototype_ds=self.raster, xoff=xoffset, yoff=yoffset )
-        )
         
-        return '%s%s.tif' % (self.output, province_name)
+        # One geotiff per polygon over its envelope, filled in tile by tile
+        if files is None:
+            files = names
+        outputs, boxes, datasets, builders = [], [], [], []
+        for name, wkb in zip(files, wkbs):
+            box = self.pixelBox(geoTrans, ogr.CreateGeometryFromWkb(wkb).GetEnvelope(), xsize, ysize)
+            
+            outputs.append(os.path.join(self.output, '%s.tif' % name))
+            ds = gtiffDriver.Create(outputs[-1], box[2], box[3], 1, gdal.GDT_UInt32)
+            ds.SetGeoTransform(self.offsetTransform(geoTrans, box[0], box[1]))
+            ds.SetProjection(self.srcImage.GetProjection())
+            datasets.append(ds)
+            boxes.append(box)
+            if tables:
+                builders.append(TableBuilder(os.path.join(self.output, 'Tables'), (ysize, xsize), geoTrans))
         
+        # Only polygons whose envelope overlaps a tile are rasterized for it
+        jobs = []
+        for tile in tiles(xsize, ysize, self.tile_size):
+            polys = [(k+1, wkbs[k]) for k, box in enumerate(boxes) if self.overlaps(box, tile)]
+            jobs.append((window, geoTrans, tile, polys, mask_file))
         
-    def clipToMask(self):
+        if self.workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            results = _boundedMap(executor, _clipTile, ((self,) + job for job in jobs), self.workers)
+        else:
+            executor = None
+            results = (self.clipTile(*job) for job in jobs)
+        
+        # Geotiff write time and lit pixels per polygon
+        write_seconds = np.zeros(len(names))
+        write_pixels = np.zeros(len(names), dtype=np.int64)
+        try:
+            for pieces in results:
+                found = dict((label - 1, (pixels, values)) for label, pixels, values in pieces)
+                for k, (pixels, values) in found.items():
+                    start = time.perf_counter()
+                    
+                    # Lit pixels of the tile written into the polygon's geotiff, the rest stays 0
+                    rows = pixels // xsize - boxes[k][1]
+                    cols = pixels % xsize - boxes[k][0]
+                    r0, c0 = rows.min(), cols.min()
+                    block = np.zeros((rows.max()-r0+1, cols.max()-c0+1), dtype=np.uint32)
+                    block[rows-r0, cols-c0] = values
+                    datasets[k].GetRasterBand(1).WriteArray(block, int(c0), int(r0))
+                    write_seconds[k] += time.perf_counter() - start
+                    write_pixels[k] += len(pixels)
+                for k, builder in enumerate(builders):
+                    builder.add(*found.get(k, ([], [])))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        
+        for name, ds, seconds, pixels in zip(names, datasets, write_seconds, write_pixels):
+            start = time.perf_counter()
+            ds.FlushCache()
+            self.log.emit({'stage': 'geotiff write', 'province': name, 'pixels': int(pixels), 'seconds': seconds + time.perf_counter() - start})
+        del datasets, ds
+        
+        for name, file_name, builder in zip(names, files, builders):
+            with self.log.stage('table build', name) as record:
+                table = builder.table()
+                self.tables.save(file_name, table)
+                record['pixels'] = int(np.size(table.index))
+                del table
+                builder.close()
+        
+        return outputs
+    
+    def clipTile(self, window, geoTrans, tile, polys, mask_file=None):
         '''
-        Clip raster image using shapefile outlines of provinces.
-        Save results to geotiff - compatible with QGIS
+        Lit pixels of one tile of a window, grouped by polygon. polys are
+        (label, WKB) pairs. Returns (label, flat window index, values) for
+        each polygon with lit pixels in the tile, pixels in raster order.
         '''
-        # Create an OGR layer from a boundary shapefile
-        DriverName = "ESRI Shapefile"
-        driver = ogr.GetDriverByName(DriverName)
-        shapef = driver.Open('%s.shp' % self.shp)
-        lyr = shapef.GetLayer()
-        
-        # Map points to pixels for drawing the 
-        # boundary on a blank 8-bit, 
-        # black and white, mask image.
-        for province in range(0,lyr.GetFeatureCount()):
-            if lyr.GetFeature(province).GetField('name') == 'NULL':
-                continue
+        xoff, yoff, xsize, ysize = window
+        tx, ty, tw, th = tile
+        if not polys:
+            return []
+        with self.log.stage('raster load', tile=list(tile), pixels=tw*th):
+            values = self.readTile(window, tile, mask_file)
+        
+        with self.log.stage('clip/rasterize', tile=list(tile), polygons=len(polys)) as record:
+            tileTrans = self.offsetTransform(geoTrans, tx, ty)
+            labels = self.rasterizeLabels([ogr.CreateGeometryFromWkb(wkb) for label, wkb in polys], [label for label, wkb in polys], tileTrans, (tw, th)).ravel()
             
-            self.initialClip(shapef, lyr, openfile=False)
+            # Group lit pixels inside polygons by label; stable sort keeps each group in raster order
+            lit = np.flatnonzero((values > 0) & (labels > 0))
+            record['pixels'] = int(np.size(lit))
+            if np.size(lit) == 0:
+                return []
+            lit = lit[np.argsort(labels[lit], kind='stable')]
+            lit_labels = labels[lit]
+            starts = np.flatnonzero(np.concatenate(([True], lit_labels[1:] != lit_labels[:-1])))
+            ends = np.append(starts[1:], len(lit))
             
-   
-    def imageToArray(self,i):
-        """
-        Convert the rasterized clipper shapefile 
-        to a mask for use within GDAL.
-        """
-        a=gdalnumeric.fromstring(i.tostring(),'b')
-        a.shape=i.im.size[1], i.im.size[0]
-        return a
+            index = (ty + lit // tw) * xsize + tx + lit % tw
+            lit_values = values[lit].astype(np.uint32)
+            return [(int(lit_labels[start]), index[start:end], lit_values[start:end]) for start, end in zip(starts, ends)]
+    
+    def readTile(self, window, tile, mask_file=None):
+        # Flat source image values of a tile of a window, masked pixels set to 0
+        xoff, yoff, xsize, ysize = window
+        tx, ty, tw, th = tile
+        values = self.srcImage.GetRasterBand(1).ReadAsArray(xoff + tx, yoff + ty, tw, th).ravel()
+        
+        # Water and uninhabitable pixels get no weight
+        if mask_file is not None:
+            excluded = gdal.Open(mask_file).GetRasterBand(1).ReadAsArray(tx, ty, tw, th).ravel() > 0
+            values = np.where(excluded, 0, values)
+        return values
+    
+    def rasterizeLabels(self, geoms, labels, geoTrans, size):
+        '''
+        Rasterize polygons in one pass into an integer label raster of
+        size (width, height) at geoTrans: labels[k] inside geoms[k], 0 outside
+        all polygons
+        '''
+        labelImage = Image.new("I", size, 0)
+        rasterize = ImageDraw.Draw(labelImage)
+        
+        # Largest polygons first, so enclaves are drawn over the province containing them
+        for k in sorted(range(len(geoms)), key=lambda k: -geoms[k].GetArea()):
+            for rings in self.polygonRings(geoms[k]):
+                # Exterior ring gets the label, holes are cleared
+                for ring, fill in zip(rings, [labels[k]] + [0]*(len(rings)-1)):
+                    pts = np.array(ring, dtype=np.float64)[:,:2]
+                    pixel, line = self.world2Pixel(geoTrans, pts[:,0], pts[:,1])
+                    rasterize.polygon(list(zip(pixel.tolist(), line.tolist())), fill)
+        
+        labelArray = np.array(labelImage)
+        if max(labels) < 2**16: # Small integer labels group with a radix sort
+            labelArray = labelArray.astype(np.uint16)
+        return labelArray
+    
+    def polygonRings(self, geom):
+        # Point lists of each polygon in a POLYGON or MULTIPOLYGON, exterior ring first
+        if geom.GetGeometryName() == 'POLYGON':
+            polys = [geom]
+        else:
+            polys = [geom.GetGeometryRef(i) for i in range(geom.GetGeometryCount())]
+        for poly in polys:
+            yield [poly.GetGeometryRef(i).GetPoints() for i in range(poly.GetGeometryCount())]
+            
+    def __getstate__(self):
+        # gdal datasets cannot be pickled, reopen in worker processes
+        state = self.__dict__.copy()
+        del state['srcImage']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.srcImage = gdal.Open(self.raster)
     
-    def arrayToImage(self,a):
-        """
-        Converts a gdalnumeric array to a 
-        Python Imaging Library Image.
-        """
-        i=Image.fromstring('L',(a.shape[1],a.shape[0]),
-                (a.astype('b')).tostring())
-        return i
-         
     def world2Pixel(self,geoMatrix, x, y):
         """
         Uses a gdal geomatrix (gdal.GetGeoTransform()) to calculate
@@ -211,60 +442,120 @@ class Clip(object):
         ulY = geoMatrix[3]
         xDist = geoMatrix[1]
         yDist = geoMatrix[5]
-        pixel = np.round((x - ulX) / xDist).astype(np.int)
-        line = np.round((y - ulY) / yDist).astype(np.int)
+        pixel = np.round((x - ulX) / xDist).astype(int)
+        line = np.round((y - ulY) / yDist).astype(int)
         return (pixel, line) 
     
-    def OpenArray(self, array, prototype_ds = None, xoff=0, yoff=0 ):
-        ds = gdal.Open( gdalnumeric.GetArrayFilename(array) )
-    
-        if ds is not None and prototype_ds is not None:
-            if type(prototype_ds).__name__ == 'str':
-                prototype_ds = gdal.Open( prototype_ds )
-            if prototype_ds is not None:
-                gdalnumeric.CopyDatasetInfo( prototype_ds, ds, xoff=xoff, yoff=yoff )
-        return ds
-        
     
 class Portfolio(object):
     '''
     Take aggregate portfolio data, split by province, distribute
     by weighted probability using nighttime lights data
     '''
-    def __init__(self,country,image_file,portfolio_file,resolution,LOB,peril,geodatafilepath):
+    def __init__(self,country,image_file,portfolio_file,resolution,LOB,peril,geodatafilepath,workers=1,seed=None,strategy='cdf',realizations=1,output_file=None,intermediate=False,output_format='csv',tables=None,interactive=True,memory_budget=MEMORY_BUDGET,weight_transform=None,edm_directory=None,pipeline=False,log=None):
         self.geodatafilepath = geodatafilepath
         
-        if resolution == 'State/Province': # Get data from portfolio file if at state/province level
-            portfile = pandas.read_csv(portfolio_file,sep=",",usecols = (0,1,2),encoding='latin-1')
+        # Location count and total TIV per region (province or postal code), see PortfolioReader.
+        # Portfolio files are read in chunks and summed per region for this LOB as they are read.
+        if resolution in ('State/Province', 'Postal Code'): # Get data from portfolio file if at state/province or postal code level
+            if isinstance(portfolio_file, pandas.DataFrame):
+                totals = portfolioTotals(aggregateChunk(portfolio_file, LOB))
+            else:
+                totals = readPortfolio(portfolio_file, LOB)
         elif resolution == 'Country': # Format country-level data correctly
-            portfile = np.reshape(portfolio_file,(1,3))
+            totals = portfolioTotals(aggregateChunk(pandas.DataFrame([list(portfolio_file)]), LOB))
         
         # Set portfolio parameters
-        self.portfile = np.array(portfile)
+        self.totals = totals
         self.country = country
         self.resolution = resolution
         self.LOB = LOB
         self.peril = peril
+        
+        # Number of worker processes for province disaggregation, and seed of the
+        # per-province random streams (None for fresh entropy each run)
+        self.workers = workers
+        self.seed = seed
+        
+        # Pixel sampling strategy, see SamplingTable.SAMPLERS. 'tiled' picks a tile by
+        # its total weight, then a pixel within it, for very large countries
+        if strategy not in SAMPLERS:
+            raise ValueError('Unknown sampling strategy: %s' % strategy)
+        self.strategy = strategy
+        
+        # Sampling weights derived from radiance, see SamplingTable.WEIGHT_TRANSFORMS.
+        # Raw radiance unless a transform is given; each transformed table is cached once per raster.
+        if weight_transform is None:
+            weight_transform = LOB_TRANSFORMS.get(LOB, [])
+        for step in weight_transform:
+            if step[0] not in WEIGHT_TRANSFORMS:
+                raise ValueError('Unknown weight transform: %s' % step[0])
+        self.weight_transform = weight_transform
+        
+        # Number of stochastic realizations of the portfolio generated in one pass
+        self.realizations = realizations
+        
+        # Compiled output of all locations, streamed province by province, as .csv or
+        # binary .npy (see PointWriter.WRITERS). Per-province Points\<province>.csv
+        # files are only written as intermediates for debugging.
+        if output_format not in WRITERS:
+            raise ValueError('Unknown output format: %s' % output_format)
+        if output_file is None:
+            if resolution == 'Country':
+                output_file = os.path.join(geodatafilepath, country, 'Provinces', 'Points', '%s.%s' % (country, output_format))
+            elif resolution == 'Postal Code':
+                output_file = os.path.join(geodatafilepath, country, 'Provinces', '%sPostalPtsCompiled.%s' % (country, output_format))
+            else:
+                output_file = os.path.join(geodatafilepath, country, 'Provinces', '%sProvincePtsCompiled.%s' % (country, output_format))
+        self.output_file = output_file
+        self.output_format = output_format
+        self.intermediate = intermediate
+        
+        # EDM location/account import files written from the same batches, see EDMGenerator
+        self.edm_directory = edm_directory
+        
+        # Load the next provinces' tables and write finished batches in background threads,
+        # overlapping disk I/O with sampling (see Pipeline)
+        self.pipeline = pipeline
+        
+        # Ask the user to resolve mismatched province names; batch runs skip them instead
+        self.interactive = interactive
+        
+        # Stage timing and memory report, see StageLog
+        if log is None:
+            log = StageLog()
+        self.log = log.bind(country=country, resolution=resolution, LOB=LOB, peril=peril)
 
         # Polygon shapefile used to clip
         if resolution == 'State/Province':
-            self.shp = r'%s\Boundaries\ne_10m_admin_1_states_provinces\Separated by countries\ne_10m_admin_1_states_provinces_admin__%s' % (geodatafilepath, country)
-        elif resolution == 'Country':
-            self.shp = r'%s\Boundaries\ne_10m_admin_0_countries\Separated by countries\ne_10m_admin_0_countries_ADMIN__%s' % (geodatafilepath, country)
+            self.shp = provinceShapefile(geodatafilepath, country)
+            self.countryshp = countryShapefile(geodatafilepath, country)
+            shapefiles = [self.shp, self.countryshp]
+        elif resolution in ('Country', 'Postal Code'):
+            self.shp = countryShapefile(geodatafilepath, country)
+            shapefiles = [self.shp]
+        shapefiles = shapefiles + exclusionShapefiles(geodatafilepath, country)
+        
+        # Postal code zones: locations are tagged with their postal code when the
+        # zones have been built by Clip, and postal-level portfolios sampled per zone
+        self.postal = PostalZones(geodatafilepath, country, postalShapefile(geodatafilepath, country))
+        if resolution == 'Postal Code':
+            shapefiles = shapefiles + [self.postal.shp]
+            if not self.postal.available():
+                raise ValueError('No postal code zones for %s, run Clip at Postal Code resolution with %s.shp' % (country, self.postal.shp))
+        
+        # Cached sampling tables, keyed on the inputs that produced the clipped rasters.
+        # A TableStore can be passed in to share loaded tables between portfolios.
+        # Tables rebuilt from clipped rasters are read in tiles within memory_budget (bytes).
+        if tables is None:
+            tables = TableStore(os.path.join(geodatafilepath, country, 'Provinces', 'Clip', 'Tables'), tableKey(image_file, shapefiles, resolution), tile_size=tileSize(memory_budget))
+        self.tables = tables
         
         # Load dataset resolution
-        resolution = np.loadtxt('%s\%s\%sResolution.csv' % (geodatafilepath, country, country),skiprows=1,delimiter=',')
+        resolution = np.loadtxt(os.path.join(geodatafilepath, country, '%sResolution.csv' % country),skiprows=1,delimiter=',')
         self.xres = resolution[0]
         self.yres = resolution[1]
                
-    def isNumber(self,s):
-        # Test if value is number
-        try:
-            float(s)
-            return True
-        except ValueError:
-            return False
-       
     def scrollMenu(self, file_province_name, shp_province_names):
         # Drop-down menu to select correct province
         root = tkinter.Tk()
@@ -294,165 +585,448 @@ class Portfolio(object):
         return match_province
     
     def provinceQC(self,file_province_names,shp_province_names):
-        # Gets user input on any province names that do not match between shp and portfolio files
-        QC_province = [i for i in file_province_names if i in shp_province_names]
-        mismatch_file = [i for i in file_province_names if not i in shp_province_names] 
-        mismatch_shp = [i for i in shp_province_names if not i in file_province_names] 
+        # Match province names between portfolio and shp files. Only names that cannot be
+        # matched automatically are asked for, and only in interactive mode.
+        matcher = NameMatcher(shp_province_names, os.path.join(self.geodatafilepath, self.country, '%sProvinceAliases.json' % self.country))
+        QC_province = []
         name_pairs = {}
-        for i in mismatch_file:
-            if np.isnan(i):
+        for i in file_province_names:
+            if isinstance(i, float) and np.isnan(i):
                 continue
-            user_input = self.scrollMenu(i,mismatch_shp)
-            name_pairs[i] = user_input
-            if user_input == 'None':
+            match, candidates = matcher.match(i)
+            if match is None:
+                if not self.interactive:
+                    print("Invalid province name: ",i)
+                    name_pairs[i] = 'None'
+                    continue
+                match = self.scrollMenu(i, (candidates or sorted(shp_province_names)) + ['None'])
+                matcher.confirm(i, match)
+            if match != i:
+                name_pairs[i] = match
+            if match == 'None':
                 continue
-            QC_province.append(user_input)            
+            QC_province.append(match)
+        matcher.save()
         return QC_province, name_pairs
     
-    def distribute_locs(self): 
+    def postalQC(self, file_codes):
+        # Postal codes must match exactly, unknown codes are dropped
+        known = []
+        name_pairs = {}
+        for code in file_codes:
+            if code in self.postal.zone:
+                known.append(code)
+            else:
+                print("Invalid postal code: ",code)
+                name_pairs[code] = 'None'
+        return known, name_pairs
+    
+    def regionJobs(self):
+        '''
+        Jobs of the portfolio: (province, count, total TIV), or batches of postal
+        codes (see postalJobs), after matching region names to the boundaries.
+        Returns the jobs and the regions holding locations or TIV that were
+        skipped for unknown names or missing light data.
+        '''
+        # Province names from portfolio data
+        province_names = list(self.totals.index)
+        
+        if self.resolution == 'Postal Code':
+            catalog = self.postal.zone
+            province_names, corrected_pairs = self.postalQC(province_names)
+        else:
+            # Boundary catalog of the shapefile
+            catalog = boundaryCatalog(self.shp, self.geodatafilepath, self.country)
+            
+            # Province names from boundary shapefile
+            shp_province_names = catalog.names()
+            
+            # Correct any mismatches between province lists
+            province_names, corrected_pairs = self.provinceQC(province_names, shp_province_names)
+        skipped = [name for name in self.totals.index if corrected_pairs.get(name) == 'None']
         
-        # Create an OGR layer from a boundary shapefile
-        DriverName = "ESRI Shapefile"
-        driver = ogr.GetDriverByName(DriverName)
-        shapef = driver.Open('%s.shp' % self.shp)
-        lyr = shapef.GetLayer()
+        # Replace any mismatched provinces with correct province names, summing names matched
+        # to the same province and removing any data that does not match known provinces
+        matched = np.array([corrected_pairs.get(name, name) for name in self.totals.index], dtype=object)
+        known = matched != 'None'
+        totals = self.totals[known].groupby(matched[known], sort=False).sum()
+        cnt = totals['locCount'].to_dict()
+        tiv = totals['locTIV'].to_dict()
+        province_names = list(totals.index)
         
-        # Province names from portfolio data
-        province_names = self.portfile[:,0]
-        
-        # Province names from boundary shapefile
-        shp_province_names = []
-        for i in range(lyr.GetFeatureCount()):
-            province_feature = lyr.GetFeature(i)
-            shp_province_names.append(province_feature.GetField(province_feature.GetFieldIndex('name')))
-        
-        # Pair province names with portfolio data
-        cnt = dict(zip(self.portfile[:,0],self.portfile[:,1]))
-        tiv = dict(zip(self.portfile[:,0],self.portfile[:,2]))
-        
-        # Correct any mismatches between province lists
-        province_names, corrected_pairs = self.provinceQC(province_names, shp_province_names)
-        
-        # Replace any mismatched provinces with correct province names
-        for i in corrected_pairs:
-            if corrected_pairs[i] == 'None': # Remove any data that does not match known provinces
-                cnt.pop(i)
-                tiv.pop(i)
-                continue
-            cnt[corrected_pairs[i]] = cnt.pop(i)
-            tiv[corrected_pairs[i]] = tiv.pop(i)
+        # Regions without locations have nothing to distribute; their TIV, if any, is reported as skipped
+        for province in province_names:
+            if cnt[province] <= 0 and tiv[province] != 0:
+                print("No locations to distribute TIV of province: ",province)
+        skipped.extend(province for province in province_names if cnt[province] <= 0)
+        province_names = [province for province in province_names if cnt[province] > 0]
         
-        if self.resolution == 'Country':
-            cnt[self.country] = int(cnt[self.country])
-            tiv[self.country] = float(tiv[self.country])     
-        for key in cnt: # Clean number strings, remove commas, set dtype
-            if self.isNumber(cnt[key]):
-                cnt[key] = int(cnt[key])
-            else:
-                cnt[key] = int(cnt[key].replace(',',''))
-            if self.isNumber(tiv[key]):
-                tiv[key] = float(tiv[key])
+        jobs = []
+        if self.resolution == 'Postal Code':
+            # Zone table opened once, codes sampled in batches rather than one job per code
+            if self.postalTable() is None:
+                print("No postal zone table for ",self.country,", run Clip at Postal Code resolution")
+                skipped.extend(province_names)
             else:
-                tiv[key] = float(tiv[key].replace(',',''))
+                jobs = self.postalJobs(province_names, cnt, tiv)
+            province_names = []
+        for province in province_names:
+            # Check for province name not matching shapefile data
+            if province not in catalog:
+                print("Invalid province name: ",province)
+                skipped.append(province)
+                continue
             
+            # Check for image file not being produced
+            if not self.hasLights(province):
+                print("No clipped light data for province: ",province)
+                skipped.append(province)
+                continue
+            
+            jobs.append((province, int(cnt[province]), float(tiv[province])))
+        
+        # Regions without locations or TIV are dropped quietly
+        exposure = (self.totals['locCount'].abs() + self.totals['locTIV'].abs()).to_dict()
+        exposure.update((name, abs(cnt[name]) + abs(tiv[name])) for name in cnt)
+        return jobs, [name for name in skipped if exposure.get(name, 0) > 0]
+    
+    def distribute_locs(self): 
+        '''
+        Distribute the portfolio's locations to the compiled output. Returns the
+        number of locations written and the regions skipped (see regionJobs).
+        '''
+        # Jobs per province or batch of postal codes
+        jobs, skipped = self.regionJobs()
+        
         # Check to see if output directory exists - clear if any old data is present
-        output = r'%s\%s\Provinces\Points' % (self.geodatafilepath, self.country)
+        output = os.path.join(self.geodatafilepath, self.country, 'Provinces', 'Points')
         if not os.path.exists(output):
             os.makedirs(output)
         else:
             filelist = [f for f in os.listdir(output) if f.endswith('.csv')]
-            os.chdir(output)
             for f in filelist:
-                os.remove(f)
+                os.remove(os.path.join(output, f))
         
-        for province in province_names:
-            lyr.SetAttributeFilter("name = '%s'" % province)
-            poly = lyr.GetNextFeature()
-            
-            # Get extent of polygon for country/state/province
-            try:
-                minX, maxX, minY, maxY = poly.GetGeometryRef().GetEnvelope()
-            except: # Check for province name not matching shapefile data
-                print("Invalid province name: ",province)
-                continue
-            
-            if maxY > 75:
-                maxY = 75
-            
-            # Load clipped light image file
+        # Append each province's batch to the compiled output as it is produced, in province order
+        writer = WRITERS[self.output_format](self.output_file, self.outputColumns())
+        edm = None
+        total = 0
+        try:
+            if self.edm_directory is not None:
+                edm = EDM(self.country, self.LOB, self.peril, self.edm_directory)
+            write = functools.partial(self.writeBatch, writer, edm)
+            if self.pipeline:
+                background = BackgroundWriter(write)
+                write = background.put
             try:
-                provArray = gdalnumeric.LoadFile(r'%s\%s\Provinces\Clip\%s.tif' % (self.geodatafilepath, self.country, province))
-            except: # Check for image file not being produced
-                print("Invalid province name: ",province)
-                province = input("Please input correct province name, or None if not available. ")
-                if province == 'None' or province == 'none':
-                    continue
-                provArray = gdalnumeric.LoadFile(r'%s\%s\Provinces\Clip\%s.tif' % (self.geodatafilepath, self.country, province))
-            
-            # Calculate average value per location
-            if self.resolution == 'State/Province':
-                try:
-                    avg_TIV = np.float(tiv[province])/cnt[province]
-                except ZeroDivisionError:
-                    avg_TIV = 0
-            elif self.resolution == 'Country':
-                avg_TIV = np.float(self.portfile[0,2])/np.float(self.portfile[0,1])
-            
-            # Produce weighted distribution
-            cumdist = list(self.accumulate(provArray.flat))
-            
-            # Check for light data not existing - generally uninhabited islands, etc.
-            if np.max(cumdist) == 0:
-                print(province, "does not have any available light data.")
+                for locdist_pandas in self.distributeJobs(jobs):
+                    write(locdist_pandas)
+                    total += len(locdist_pandas)
+            except BaseException:
+                if self.pipeline:
+                    background.close(raise_error=False)
+                raise
+            if self.pipeline:
+                background.close()
+        finally:
+            # Finish the compiled output
+            with self.log.stage('merge', locations=total):
+                writer.close()
+                if edm is not None:
+                    edm.close()
+        return total, skipped
+    
+    def writeBatch(self, writer, edm, locdist_pandas):
+        # Write one province's (or batch of postal codes') locations to the compiled output and EDM files
+        region = 'PostalCode' if self.resolution == 'Postal Code' else 'State/Province'
+        province = locdist_pandas[region].iloc[0] if len(locdist_pandas) else None
+        with self.log.stage('output write', province, locations=len(locdist_pandas)):
+            writer.write(locdist_pandas)
+        if edm is not None:
+            with self.log.stage('EDM write', province, locations=len(locdist_pandas)):
+                edm.write(locdist_pandas[self.outputColumns()])
+    
+    def distributeJobs(self, jobs):
+        '''
+        Distribute (province, count, total TIV) jobs, or postal code batches (see
+        postalJobs), serially or across worker processes. Yields a DataFrame of
+        locations per job, in job order.
+        '''
+        # Independent random stream per province, so results do not depend on the number of workers
+        seeds = np.random.SeedSequence(self.seed).spawn(len(jobs))
+        
+        if self.workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for locdist_pandas in _boundedMap(executor, _distributeProvince, ((self, job, seed) for job, seed in zip(jobs, seeds)), self.workers):
+                    if locdist_pandas is not None:
+                        yield locdist_pandas
+        elif self.pipeline:
+            # Tables of the next provinces are loaded while the current one is sampled
+            for (job, seed), table in prefetch(list(zip(jobs, seeds)), lambda job_seed: self.jobTable(job_seed[0])):
+                locdist_pandas = self.distributeJob(job, seed, table)
+                if locdist_pandas is not None:
+                    yield locdist_pandas
+        else:
+            for job, seed in zip(jobs, seeds):
+                locdist_pandas = self.distributeJob(job, seed)
+                if locdist_pandas is not None:
+                    yield locdist_pandas
+    
+    def distributeJob(self, job, seed=None, table=None):
+        if self.resolution == 'Postal Code':
+            return self.distributeZones(*job, seed=seed, table=table)
+        return self.distributeProvince(*job, seed=seed, table=table)
+    
+    def jobTable(self, job):
+        # Table of a job loaded ahead of sampling; postal batches share the zone table
+        if self.resolution == 'Postal Code':
+            return self.postalTable(self.weight_transform)
+        return self.loadTable(job[0], True)
+    
+    def clipName(self, province):
+        # Clip file and table name of a province, reserved name for the whole country
+        if self.resolution == 'Country':
+            return COUNTRY_REGION % self.country
+        return province
+    
+    def clipFile(self, province):
+        return os.path.join(self.geodatafilepath, self.country, 'Provinces', 'Clip', '%s.tif' % self.clipName(province))
+    
+    def hasLights(self, province):
+        # Clipped light image or cached sampling table is available for province
+        if self.resolution == 'Postal Code':
+            return province in self.postal.zone and self.postalTable() is not None
+        if self.clipName(province) in self.tables.loaded:
+            return True
+        return os.path.exists(self.clipFile(province)) or self.tables.load(self.clipName(province)) is not None
+    
+    def postalTable(self, transform=None):
+        # Zone-sorted table of all postal codes, None if the zones have not been built.
+        # Opened once, later calls find it in the store's loaded tables.
+        if self.tables.loaded.get(self.postal.tableName) is None and self.tables.load(self.postal.tableName) is None:
+            return None
+        return self.tables.get(self.postal.tableName, None, transform)
+    
+    def postalJobs(self, codes, cnt, tiv):
+        '''
+        Group postal codes, in zone order, into jobs of (codes, counts, TIVs) of
+        about BATCH_LOCATIONS locations, sampled and written together
+        '''
+        codes = sorted(codes, key=self.postal.zone.get)
+        jobs, batch, size = [], [], 0
+        for code in codes:
+            batch.append(code)
+            size += int(cnt[code]) * self.realizations
+            if size >= BATCH_LOCATIONS:
+                jobs.append((batch, [int(cnt[code]) for code in batch], [float(tiv[code]) for code in batch]))
+                batch, size = [], 0
+        if batch:
+            jobs.append((batch, [int(cnt[code]) for code in batch], [float(tiv[code]) for code in batch]))
+        return jobs
+    
+    def regionTable(self, province, transform):
+        # Sampling table of a province, or of a postal zone at postal code level
+        if self.resolution == 'Postal Code':
+            return self.postal.zoneTable(self.tables.get(self.postal.tableName, None, transform), province)
+        return self.tables.get(self.clipName(province), self.clipFile(province), transform)
+    
+    def provinceTable(self, province):
+        # Weight-transformed table, raw weights if the transform leaves no light data
+        # (e.g. a threshold above every pixel of a dim province)
+        table = self.regionTable(province, self.weight_transform)
+        if self.weight_transform and table.total() == 0:
+            print(province, "has no light data left after the weight transform, using raw weights.")
+            table = self.regionTable(province, [])
+        return table
+    
+    def loadTable(self, province, resident=False):
+        '''
+        Load clipped light image file as a table of lit pixels. With resident the
+        table is read into memory, except for the tiled sampler, which only reads
+        the tiles it draws from.
+        '''
+        with self.log.stage('table load', province) as record:
+            table = self.provinceTable(province)
+            if resident and self.strategy != 'tiled':
+                table = table.resident()
+            record['pixels'] = int(np.size(table.index))
+        return table
+    
+    def distributeProvince(self, province, count, total_TIV, seed=None, table=None):
+        '''
+        Distribute locations for one province. Returns a DataFrame of locations,
+        or None if the province has no light data. The province's table is loaded
+        unless already given.
+        '''
+        rng = np.random.default_rng(seed)
+        output = os.path.join(self.geodatafilepath, self.country, 'Provinces', 'Points')
+        
+        if table is None:
+            table = self.loadTable(province)
+        
+        # Calculate average value per location
+        try:
+            avg_TIV = float(total_TIV)/count
+        except ZeroDivisionError:
+            avg_TIV = 0
+        
+        # Check for light data not existing - generally uninhabited islands, etc.
+        if table.total() == 0:
+            print(province, "does not have any available light data.")
+            return
+        
+        # Weighted distribution of lat/lon, randomly distributed within ~1km grid resolution
+        # Add some variability to average TIV - need to refine with better data.
+        # All realizations are drawn in one batch from the same table
+        with self.log.stage('sampling', province, locations=count*self.realizations):
+            locdist, startpt = self.samplePoints(table, count, avg_TIV, rng, self.realizations, pixels=True)
+
+        # Scale randomly-produced insured values to match known total for region, per realization
+        with self.log.stage('TIV scaling', province, locations=count*self.realizations):
+            sum_TIV = np.sum(np.reshape(locdist[:,2], (self.realizations, count)), axis=1)
+            scale_TIV = np.divide(float(total_TIV), sum_TIV, out=np.zeros_like(sum_TIV), where=sum_TIV != 0)
+            locdist[:,2] = locdist[:,2] * np.repeat(scale_TIV, count)
+        
+        locdist_pandas = pandas.DataFrame(locdist, columns = ['Lat','Lon','TIV'])
+        locdist_pandas['State/Province'] = province
+        if self.resolution == 'Postal Code':
+            locdist_pandas['PostalCode'] = province
+        elif self.postal.available():
+            # Postal code of the lights pixel each location was drawn from
+            with self.log.stage('postal lookup', province, locations=count*self.realizations):
+                locdist_pandas['PostalCode'] = self.postal.lookupPixels(table, startpt)
+        locdist_pandas['Country'] = self.country
+        locdist_pandas['LOB'] = self.LOB
+        locdist_pandas['Peril'] = self.peril
+        locdist_pandas['Realization'] = np.repeat(np.arange(self.realizations), count)
+        if self.intermediate:
+            locdist_pandas.to_csv(os.path.join(output, '%s.csv' % province), columns=self.outputColumns(), index=False)
+        return locdist_pandas
+    
+    def distributeZones(self, codes, counts, total_TIVs, seed=None, table=None):
+        '''
+        Distribute locations for a batch of postal codes with one search of the
+        zone-sorted table, whatever the sampling strategy. Returns a DataFrame
+        of locations, realization by realization and zone by zone, or None if
+        no zone of the batch has light data.
+        '''
+        rng = np.random.default_rng(seed)
+        if table is None:
+            with self.log.stage('table load', codes[0]) as record:
+                table = self.postalTable(self.weight_transform)
+                record['pixels'] = int(np.size(table.index))
+        zones = np.array([self.postal.zone[code] for code in codes], dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+        total_TIVs = np.asarray(total_TIVs, dtype=np.float64)
+        
+        # Zones left without weight by the transform use raw weights, zones without lights are skipped
+        tables = [table]
+        use = [self.postal.zoneTotals(table, zones)[3] > 0]
+        if self.weight_transform and not use[0].all():
+            raw = self.postalTable()
+            tables.append(raw)
+            use.append(~use[0] & (self.postal.zoneTotals(raw, zones)[3] > 0))
+        lit = np.logical_or.reduce(use) | (counts == 0)
+        if not lit.all():
+            print(len(codes) - lit.sum(), "postal codes do not have any available light data, e.g.", codes[np.flatnonzero(~lit)[0]])
+        
+        frames = []
+        for table, sel in zip(tables, use):
+            sel = sel & (counts > 0)
+            if not sel.any():
                 continue
+            n = int(counts[sel].sum())
+            which = np.tile(np.repeat(np.flatnonzero(sel), counts[sel]), self.realizations)
+            avg_TIV = (total_TIVs / np.maximum(counts, 1))[which]
+            with self.log.stage('sampling', codes[0], locations=n*self.realizations, zones=int(sel.sum())):
+                startpt = self.postal.sample(table, zones[sel], counts[sel], rng, self.realizations)
+                locdist = self.placePoints(table, startpt, avg_TIV, rng)
             
-            # Weighted distribution of lat/lon, randomly distributed within ~1km grid resolution
-            # Add some variability to average TIV - need to refine with better data.
-            loc = np.zeros((cnt[province],2))
-            locdist = np.zeros((cnt[province],3))
-            for i in range(cnt[province]):
-                loc[i,:] = self.setpt(provArray,cumdist,minX, minY, maxX, maxY)
-                locdist[i,1] = loc[i,1] - random.random() * self.xres
-                locdist[i,0] = loc[i,0] + random.random() * self.yres
-                locdist[i,2] = np.random.normal(loc=avg_TIV,scale=avg_TIV/10.) # Note: refine std dev est
-    
-            # Scale randomly-produced insured values to match known total for region    
-            sum_TIV = np.sum(locdist[:,2])
-            scale_TIV = np.float(tiv[province])/sum_TIV
-            locdist[:,2] = locdist[:,2] * scale_TIV
-                           
+            # Scale insured values to the known total of each zone, per realization
+            with self.log.stage('TIV scaling', codes[0], locations=n*self.realizations):
+                group = np.repeat(np.arange(self.realizations), n) * len(codes) + which
+                sum_TIV = np.bincount(group, weights=locdist[:,2], minlength=self.realizations*len(codes))
+                target = np.tile(total_TIVs, self.realizations)
+                scale_TIV = np.divide(target, sum_TIV, out=np.zeros_like(sum_TIV), where=sum_TIV != 0)
+                locdist[:,2] = locdist[:,2] * scale_TIV[group]
             
             locdist_pandas = pandas.DataFrame(locdist, columns = ['Lat','Lon','TIV'])
-            locdist_pandas['State/Province'] = province
-            locdist_pandas['Country'] = self.country
-            locdist_pandas['LOB'] = self.LOB
-            locdist_pandas['Peril'] = self.peril
-            if self.resolution == 'Country':
-                locdist_pandas.to_csv('%s\%s.csv' % (output,province), columns=['Lat','Lon','TIV','Country','LOB','Peril'], index=False)
-            else:
-                locdist_pandas.to_csv('%s\%s.csv' % (output,province), columns=['Lat','Lon','TIV','State/Province','Country','LOB','Peril'], index=False)
+            locdist_pandas['PostalCode'] = np.array(codes, dtype=object)[which]
+            locdist_pandas['Realization'] = np.repeat(np.arange(self.realizations), n)
+            frames.append(locdist_pandas)
+        if not frames:
+            return
+        locdist_pandas = pandas.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        locdist_pandas['State/Province'] = locdist_pandas['PostalCode']
+        locdist_pandas['Country'] = self.country
+        locdist_pandas['LOB'] = self.LOB
+        locdist_pandas['Peril'] = self.peril
+        return locdist_pandas
+    
+    def outputColumns(self):
+        # Columns written for each location
+        if self.resolution == 'Country':
+            columns = ['Lat','Lon','TIV','Country','LOB','Peril']
+        elif self.resolution == 'Postal Code':
+            columns = ['Lat','Lon','TIV','PostalCode','Country','LOB','Peril']
+        else:
+            columns = ['Lat','Lon','TIV','State/Province','Country','LOB','Peril']
+        if self.resolution != 'Postal Code' and self.postal.available():
+            columns.insert(3, 'PostalCode')
+        if self.realizations > 1:
+            columns.append('Realization')
+        return columns
             
-    def setpt(self,zd,cumdist,x0,y0,x1,y1):
-        '''
-        Randomly place points based on cumulative distribution (weighted probability)
-        '''
-        scale = 1
-        x = random.random() * cumdist[-1]
-        loc = range(0,len(zd.flat))
-        startpt = loc[bisect.bisect(cumdist, x)]
-        w = float(np.shape(zd)[1] * scale)
-        startlat = np.floor((startpt/w))*self.yres/scale+float(y1)
-        startlon = startpt%w/scale*self.xres+float(x0)
-        startpt = [startlat, startlon]
-        return startpt
-    
-    def accumulate(self,iterable):
-        'Return running totals'
-        # accumulate([1,2,3,4,5]) --> 1 3 6 10 15
-        it = iter(iterable)
-        total = int(next(it))
-        yield total
-        for element in it:
-            total = total + int(element)
-            yield total
-            
\ No newline at end of file
+    def samplePoints(self, table, count, avg_TIV, rng=np.random, realizations=1, pixels=False):
+        '''
+        Randomly place a batch of points weighted by the lit pixels in a SamplingTable,
+        using the selected sampling strategy. Returns array of [Lat, Lon, TIV] rows,
+        count rows for each realization in turn, and with pixels the flat index of
+        the pixel each point was drawn from.
+        '''
+        # Pick lit pixels for all points at once
+        startpt = SAMPLERS[self.strategy](table, count, rng, realizations)
+        locdist = self.placePoints(table, startpt, avg_TIV, rng)
+        if pixels:
+            return locdist, startpt
+        return locdist
+    
+    def placePoints(self, table, startpt, avg_TIV, rng=np.random):
+        '''
+        [Lat, Lon, TIV] rows of points drawn from lit pixels startpt, with average
+        TIV per point (scalar or per point)
+        '''
+        geoTrans = table.geotransform
+        size = len(startpt)
+        
+        # Pixel corner to lat/lon, then jitter within the grid cell
+        lat, lon = table.pixelCorners(startpt)
+        locdist = np.zeros((size,3))
+        locdist[:,0] = lat + rng.random(size) * geoTrans[5]
+        locdist[:,1] = lon - rng.random(size) * geoTrans[1]
+        locdist[:,2] = rng.normal(loc=avg_TIV, scale=np.divide(avg_TIV, 10.), size=size) # Note: refine std dev est
+        return locdist
+
+
+def _boundedMap(executor, fn, args, depth):
+    # Results of fn over args in order, like executor.map, with at most depth calls
+    # submitted and not yet consumed, so finished tiles and batches do not pile up in memory
+    pending = collections.deque()
+    for arg in args:
+        if len(pending) == depth:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, arg))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _clipTile(args):
+    # Process pool entry point for Clip.clipTile
+    lights = args[0]
+    return lights.clipTile(*args[1:])
+
+
+def _distributeProvince(args):
+    # Process pool entry point for Portfolio.distributeJob
+    portfolio, job, seed = args
+    return portfolio.distributeJob(job, seed)
@@ -0,0 +1,219 @@
+'''
+Resident disaggregation service.
+
+Keeps sampling tables for recently used countries in memory and answers
+small ad-hoc disaggregation requests over HTTP, without reopening boundary
+files or rebuilding distributions per request. Start with
+
+    python -m root.nested.DisaggregationService image_file [--port 8765]
+
+and POST a JSON request to http://localhost:8765/disaggregate:
+
+{
+    "country": "Belgium", "resolution": "State/Province",
+    "provinces": {"Antwerp": [100, 25000000], "Liege": [50, 10000000]},
+    "LOB": "Res", "peril": "WS", "seed": 42
+}
+
+"provinces" maps province name to [location count, TIV]; names are matched
+to the boundaries as in batch runs (aliases file, normalized names). At
+Country resolution give "count" and "TIV" instead. Optional "realizations",
+"strategy" and "weight_transform" are passed to Portfolio. The response holds the points as
+{"columns": [...], "data": [[...], ...]} plus any "skipped" provinces.
+GET /status reports the table cache.
+'''
+
+import argparse
+import collections
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import pandas
+from root.nested.ClipLights import Portfolio
+from root.nested.SamplingTable import TableStore
+from root.nested import DistributeExposure
+
+
+class TableCache(object):
+    '''
+    Least-recently-used cache of sampling tables across countries, evicting
+    old tables once their arrays exceed max_bytes in total. Tables are read
+    into memory when cached, so max_bytes bounds resident memory rather than
+    memory-mapped file sizes.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.tables = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def view(self, name):
+        # Province -> table mapping for one TableStore
+        return TableCacheView(self, name)
+
+    def get(self, key):
+        with self.lock:
+            table = self.tables.get(key)
+            if table is not None:
+                self.tables.move_to_end(key)
+            return table
+
+    def put(self, key, table):
+        with self.lock:
+            if key in self.tables:
+                self.nbytes -= self.tables.pop(key).nbytes()
+            self.tables[key] = table
+            self.nbytes += table.nbytes()
+
+            # Always keep the newest table, even if it alone exceeds the cap
+            while self.nbytes > self.max_bytes and len(self.tables) > 1:
+                old_key, old_table = self.tables.popitem(last=False)
+                self.nbytes -= old_table.nbytes()
+
+    def status(self):
+        with self.lock:
+            return {'tables': len(self.tables), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+class TableCacheView(object):
+    '''
+    Mapping view of a TableCache under one name, used as TableStore.loaded
+    '''
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+
+    def __contains__(self, province):
+        return self.cache.get((self.name, province)) is not None
+
+    def get(self, province, default=None):
+        # Table, or default if missing or evicted, in one step
+        table = self.cache.get((self.name, province))
+        if table is None:
+            return default
+        return table
+
+    def __getitem__(self, province):
+        table = self.get(province)
+        if table is None:
+            raise KeyError(province)
+        return table
+
+    def __setitem__(self, province, table):
+        self.cache.put((self.name, province), table.resident())
+
+
+class DisaggregationService(object):
+    '''
+    Disaggregate requests against resident sampling tables
+    '''
+
+    def __init__(self, image_file, geodatafilepath, max_bytes=2*1024**3):
+        self.image_file = image_file
+        self.geodatafilepath = geodatafilepath
+        self.cache = TableCache(max_bytes)
+
+    def tables(self, country, resolution, store):
+        # Resident copy of a portfolio's TableStore, holding its tables in the shared cache.
+        # The cache key of the store is part of the name, so tables of replaced rasters or
+        # shapefiles are not served.
+        return TableStore(store.directory, store.key, self.cache.view((country, resolution, store.key)), store.tile_size)
+
+    def disaggregate(self, request):
+        '''
+        Generate points for one request. Returns DataFrame of points and
+        list of provinces skipped for unknown names or missing light data.
+        Unknown countries raise ValueError.
+        '''
+        country = request['country']
+        resolution = request.get('resolution', 'State/Province')
+        if os.path.basename(country) != country or not os.path.exists(os.path.join(self.geodatafilepath, country, '%sResolution.csv' % country)):
+            raise ValueError('Unknown country: %s' % country)
+        if resolution == 'Country':
+            portfolio_file = [country, int(request['count']), float(request['TIV'])]
+        else:
+            portfolio_file = pandas.DataFrame([(province, int(count), float(TIV)) for province, (count, TIV) in request['provinces'].items()],
+                                              columns=['name', 'locCount', 'locTIV'])
+
+        # Portfolio is cheap to set up: boundary catalogs are cached and loaded tables are shared
+        portfolio = Portfolio(country, self.image_file, portfolio_file, resolution, request['LOB'], request['peril'], self.geodatafilepath,
+                              seed=request.get('seed'), strategy=request.get('strategy', 'cdf'), realizations=int(request.get('realizations', 1)),
+                              weight_transform=request.get('weight_transform'), interactive=False)
+        portfolio.tables = self.tables(country, resolution, portfolio.tables)
+
+        # Province names matched without user input, as in batch runs
+        jobs, skipped = portfolio.regionJobs()
+        frames = list(portfolio.distributeJobs(jobs))
+        if frames:
+            locdist_pandas = pandas.concat(frames, ignore_index=True)
+        else:
+            locdist_pandas = pandas.DataFrame(columns=portfolio.outputColumns())
+        return locdist_pandas[portfolio.outputColumns()], skipped
+
+
+class DisaggregationHandler(BaseHTTPRequestHandler):
+
+    def respond(self, code, body):
+        data = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.respond(404, json.dumps({'error': 'Unknown path %s' % self.path}))
+            return
+        self.respond(200, json.dumps(self.server.service.cache.status()))
+
+    def do_POST(self):
+        if self.path != '/disaggregate':
+            self.respond(404, json.dumps({'error': 'Unknown path %s' % self.path}))
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            locdist_pandas, skipped = self.server.service.disaggregate(request)
+        except (KeyError, TypeError, ValueError) as error:
+            self.respond(400, json.dumps({'error': '%s: %s' % (type(error).__name__, error)}))
+            return
+        except Exception as error:
+            self.respond(500, json.dumps({'error': '%s: %s' % (type(error).__name__, error)}))
+            return
+        points = json.loads(locdist_pandas.to_json(orient='split', index=False))
+        self.respond(200, json.dumps({'columns': points['columns'], 'data': points['data'], 'skipped': skipped}))
+
+
+class DisaggregationServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, DisaggregationHandler)
+        self.service = service
+
+
+def serve(image_file, geodatafilepath, host='localhost', port=8765, max_bytes=2*1024**3):
+    # Run service until interrupted
+    server = DisaggregationServer((host, port), DisaggregationService(image_file, geodatafilepath, max_bytes))
+    print('Serving disaggregation requests on http://%s:%d' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resident exposure disaggregation service')
+    parser.add_argument('image_file', help='Nighttime lights raster the clipped tables were built from')
+    parser.add_argument('--geodatafilepath', default=DistributeExposure.geodatafilepath)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-bytes', type=int, default=2*1024**3, help='Memory cap of the sampling table cache')
+    args = parser.parse_args()
+    serve(args.image_file, args.geodatafilepath, args.host, args.port, args.max_bytes)
@@ -12,9 +12,10 @@ import tkinter.filedialog as tkFileDialog
 import os
 import sys
 from root.nested.ClipLights import Clip, Portfolio
+from root.nested.Boundaries import boundaryCatalog, provinceShapefile
+from root.nested.StageLog import StageLog
 import numpy as np
-# from root.nested.EDMGenerator import EDM
-import ogr
+from root.nested.EDMGenerator import exportPoints
 import pandas
 import cProfile
 
@@ -30,7 +31,7 @@ def countryList():
 
 def resolutionList():
     # Choose level to distribute exposures
-    choices = ['Country', 'State/Province']
+    choices = ['Country', 'State/Province', 'Postal Code']
     label = 'Select level to distribute exposures'
     return choices, label
 
@@ -102,69 +103,45 @@ def selectPortfolio(country):
             validfile = True        
     return portfolio_file         
 
-def equalExposureTestPortfolio(country):
+def equalExposureTestPortfolio(country, num_locs=None, avg_TIV=None, datapath=geodatafilepath):
     # Generate .csv file with equal exposures in each state/province
-    shp = r'%s\Boundaries\ne_10m_admin_1_states_provinces\Separated by countries\ne_10m_admin_1_states_provinces_admin__%s' % (geodatafilepath, country)
+    # Location count and average TIV are asked for if not given
+    shp = provinceShapefile(datapath, country)
     
-    DriverName = "ESRI Shapefile"
-    driver = ogr.GetDriverByName(DriverName)
-    shapef = driver.Open('%s.shp' % shp)
-    lyr = shapef.GetLayer()
-    
-    province_names = np.zeros(0)
-    for province in range(0,lyr.GetFeatureCount()):
-        if lyr.GetFeature(province).GetField('name') != 'NULL':
-            province_names = np.append(province_names,lyr.GetFeature(province).GetField('name'))
+    province_names = np.array(boundaryCatalog(shp, datapath, country).names())
     
     portfolio_file = np.zeros((np.size(province_names),2))
-    num_locs = inputButton('Enter number of locations to distribute.')
-    avg_TIV = inputButton('Enter average TIV.')
+    if num_locs is None:
+        num_locs = inputButton('Enter number of locations to distribute.')
+    if avg_TIV is None:
+        avg_TIV = inputButton('Enter average TIV.')
     portfolio_file[:,0] = num_locs
     portfolio_file[:,1] = num_locs * avg_TIV
     portfolio_file_pandas = pandas.DataFrame(portfolio_file, index = province_names, columns = ['locCount','locTIV'])
     
-    file_path = '%s\%s\Provinces\%sEqualExposure.csv' % (geodatafilepath,country,country)
+    file_path = os.path.join(datapath, country, 'Provinces', '%sEqualExposure.csv' % country)
     portfolio_file_pandas.to_csv(file_path, columns=['locCount','locTIV'], index=True, index_label='name')
     return file_path
 
-def generateLights(country,image_file,resolution,run=True):
+def generateLights(country,image_file,resolution,run=True,log=None):
     if run:
         #     Generate clipped images of satellite data
-        lights = Clip(country,image_file,resolution,geodatafilepath)      
+        lights = Clip(country,image_file,resolution,geodatafilepath,log=log)      
         lights.clipToMask()
     
-def generatePoints(country,image_file,resolution,LOB,peril):
+def generatePoints(country,image_file,resolution,LOB,peril,log=None,runEDM=False):
     # Distribute portfolio of exposures
-    if resolution == 'State/Province':
+    if resolution in ('State/Province', 'Postal Code'):
         portfolio_file = selectPortfolio(country)
     if resolution == 'Country':
         numlocs = inputButton('Enter number of locations to distribute.')
         avg_TIV = inputButton('Enter average TIV.')     
         portfolio_file = [country, numlocs, avg_TIV*numlocs]  
-    portfolio = Portfolio(country,image_file,portfolio_file,resolution,LOB,peril,geodatafilepath)  
+    # EDM import files are written from the points as they are generated
+    edm_directory = edmDirectory(country) if runEDM else None
+    portfolio = Portfolio(country,image_file,portfolio_file,resolution,LOB,peril,geodatafilepath,edm_directory=edm_directory,log=log)  
     portfolio.distribute_locs()
-    
-    if resolution == 'State/Province':
-        mergeCSV(r'C:\PF2\QGIS Valmiera\Datasets\%s\Provinces\Points' % country, r'C:\PF2\QGIS Valmiera\Datasets\%s\Provinces\%sProvincePtsCompiled.csv' % (country, country), country)
-
-def mergeCSV(srcDir,destCSV,country):
-    # Merge individual state/province .csv files into one country-level file
-    with open(destCSV,'w') as destFile:
-        header=''
-        for root,dirs,files in os.walk(srcDir):
-            for f in files:
-                if f.endswith(".csv"):
-                    if country in f:
-                        continue
-                    else:
-                        with open(os.path.join(root,f),'r') as csvfile:
-                            if header=='':
-                                header=csvfile.readline()
-                                destFile.write(header)
-                            else:
-                                csvfile.readline()
-                            for line in csvfile:
-                                destFile.write(line)   
+    return portfolio
 
 def inputButton(title):
     # Manually set number of locations to distribute
@@ -186,26 +163,21 @@ def inputButton(title):
       
     root.mainloop()
       
-    numlocs = np.int(entry.get())
+    numlocs = int(entry.get())
     root.withdraw()
     return numlocs
 
-def generateEDM(country, province, LOB, peril):
-    # Produce set of EDM import files
-    edm = EDM(country, province, LOB, peril)
-    edm.genLocFile()
-    edm.outputFiles()
+def edmDirectory(country):
+    return os.path.join(geodatafilepath, country, 'EDM')
+
+def generateEDM(country, points_file, LOB, peril):
+    # Produce set of EDM import files from a compiled points file, read in batches
+    return exportPoints(points_file, country, LOB, peril, edmDirectory(country))
     
-def EDMOn(resolution, country, LOB, peril, runEDM=True):
-    #     Generate EDM file
+def EDMOn(portfolio, runEDM=True):
+    #     Generate EDM files for points already produced by a portfolio
     if runEDM:
-        if resolution == 'Country':
-            generateEDM(country, country, LOB, peril)
-        if resolution == 'State/Province':
-            province_files = os.listdir(path='%s\%s\Provinces\Points' % (geodatafilepath,country))
-            for province in province_files:
-                if province[:-4] != country: # Trim off '.csv', exclude full country file
-                    generateEDM(country, province[:-4], LOB, peril)
+        generateEDM(portfolio.country, portfolio.output_file, portfolio.LOB, portfolio.peril)
         
 def runMain():
     # User input
@@ -221,14 +193,15 @@ def runMain():
         run=False
         
 #     Input filename of nighttime lights dataset. 
-    image_file = r'%s\Night Lights\No-Saturation-F16_20100111-20110731_rad_v4.geotiff\No-Saturation-F16_20100111-20110731_rad_v4.geotiff\F16_20100111-20110731_rad_v4.avg_vis.tif' % geodatafilepath
+    image_file = os.path.join(geodatafilepath, 'Night Lights', 'No-Saturation-F16_20100111-20110731_rad_v4.geotiff', 'No-Saturation-F16_20100111-20110731_rad_v4.geotiff', 'F16_20100111-20110731_rad_v4.avg_vis.tif')
     
-    generateLights(country,image_file,resolution,run)
+    # Stage timing and memory of this run, appended to the country's run report
+    log = StageLog(os.path.join(geodatafilepath, country, '%sRunReport.jsonl' % country))
+    
+    generateLights(country,image_file,resolution,run,log)
     
-    generatePoints(country,image_file,resolution,LOB,peril)    
-
     # Turn EDM import generator on or off with run
-    EDMOn(resolution, country, LOB, peril, runEDM=False)
+    generatePoints(country,image_file,resolution,LOB,peril,log,runEDM=False)    
 
 
 if __name__ == '__main__':
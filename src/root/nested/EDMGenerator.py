@@ -0,0 +1,130 @@
+'''
+Streaming EDM import file generator.
+
+Generated points are mapped to RMS EDM location and account import files
+(.csv) batch by batch, with the LOB/peril fields filled by column
+operations on the whole batch. Points come either straight from Portfolio
+as each province is produced, or from a compiled .csv/.npy points file read
+in chunks, so memory stays bounded by the batch size whatever the number of
+locations. Only one total per account is kept until the account file is
+written on close.
+'''
+
+import numpy as np
+import pandas
+import os
+from root.nested.PointWriter import readPoints
+
+# Rows of a compiled points file mapped at a time
+BATCH_ROWS = 1000000
+
+# Construction and occupancy fields by LOB (ATC schemes), adjust to the book
+LOB_FIELDS = {'Res': {'BLDGSCHEME': 'ATC', 'BLDGCLASS': 1, 'OCCSCHEME': 'ATC', 'OCCTYPE': 1},
+              'Com': {'BLDGSCHEME': 'ATC', 'BLDGCLASS': 1, 'OCCSCHEME': 'ATC', 'OCCTYPE': 4},
+              'Ind': {'BLDGSCHEME': 'ATC', 'BLDGCLASS': 1, 'OCCSCHEME': 'ATC', 'OCCTYPE': 12}}
+
+# Building value field and account policy type by peril
+PERIL_FIELDS = {'WS': ('WSCV1VAL', 2),
+                'EQ': ('EQCV1VAL', 1),
+                'FL': ('FLCV1VAL', 4)}
+
+# Point columns copied to location fields, when present
+POINT_FIELDS = [('Country', 'COUNTRY'), ('State/Province', 'STATE'), ('PostalCode', 'POSTALCODE'),
+                ('Lat', 'LATITUDE'), ('Lon', 'LONGITUDE')]
+
+ACCOUNT_COLUMNS = ['ACCNTNUM', 'ACCNTNAME', 'POLICYNUM', 'POLICYTYPE', 'BLANLIMAMT']
+
+
+class EDM(object):
+    '''
+    Write batches of points (pandas DataFrames of Portfolio output columns)
+    to EDM location and account import files in directory. Each realization
+    of the portfolio is one account.
+    '''
+
+    def __init__(self, country, LOB, peril, directory):
+        if LOB not in LOB_FIELDS:
+            raise ValueError('No EDM fields for LOB: %s' % LOB)
+        if peril not in PERIL_FIELDS:
+            raise ValueError('No EDM fields for peril: %s' % peril)
+        self.country = country
+        self.LOB = LOB
+        self.peril = peril
+        self.account = '%s_%s_%s' % (country, LOB, peril)
+        self.valueField, self.policyType = PERIL_FIELDS[peril]
+        self.count = 0
+        self.totals = {}
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.location_file = os.path.join(directory, '%sLoc.csv' % self.account)
+        self.account_file = os.path.join(directory, '%sAcc.csv' % self.account)
+        self.file = open(self.location_file, 'w', newline='')
+        self.header = True
+
+    def locations(self, points):
+        # EDM location fields of a batch of points
+        n = len(points)
+        if 'Realization' in points.columns:
+            accounts = self.account + '_' + points['Realization'].astype(np.int64).astype(str).values
+        else:
+            accounts = np.full(n, self.account, dtype=object)
+        locations = pandas.DataFrame({'ACCNTNUM': accounts, 'LOCNUM': np.arange(self.count+1, self.count+n+1)})
+        for column, field in POINT_FIELDS:
+            if column in points.columns:
+                locations[field] = points[column].values
+        locations['NUMBLDGS'] = 1
+        for field, value in sorted(LOB_FIELDS[self.LOB].items()):
+            locations[field] = value
+        locations[self.valueField] = points['TIV'].values
+        return locations
+
+    def write(self, points):
+        if len(points) == 0:
+            return
+        locations = self.locations(points)
+        locations.to_csv(self.file, header=self.header, index=False)
+        self.header = False
+        self.count += len(locations)
+        for account, tiv in locations.groupby('ACCNTNUM', sort=False)[self.valueField].sum().items():
+            self.totals[account] = self.totals.get(account, 0.) + tiv
+
+    def close(self):
+        self.file.close()
+        accounts = sorted(self.totals)
+        pandas.DataFrame({'ACCNTNUM': accounts,
+                          'ACCNTNAME': accounts,
+                          'POLICYNUM': ['%s_P' % account for account in accounts],
+                          'POLICYTYPE': self.policyType,
+                          'BLANLIMAMT': [self.totals[account] for account in accounts]},
+                         columns=ACCOUNT_COLUMNS).to_csv(self.account_file, index=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def pointBatches(points_file, batch_rows=BATCH_ROWS):
+    '''
+    Read a compiled points file (.csv or binary .npy, see PointWriter) in
+    batches of batch_rows points, as DataFrames
+    '''
+    if os.path.splitext(points_file)[1] == '.npy':
+        records, codes = readPoints(points_file)
+        columns = list(records.dtype.names)
+        for start in range(0, len(records), batch_rows):
+            chunk = records[start:start+batch_rows]
+            yield pandas.DataFrame(dict((column, codes[column][chunk[column]] if column in codes else chunk[column]) for column in columns), columns=columns)
+    else:
+        for chunk in pandas.read_csv(points_file, dtype={'State/Province': str, 'PostalCode': str}, chunksize=batch_rows):
+            yield chunk
+
+
+def exportPoints(points_file, country, LOB, peril, directory, batch_rows=BATCH_ROWS):
+    # EDM import files of a compiled points file. Returns the number of locations.
+    with EDM(country, LOB, peril, directory) as edm:
+        for points in pointBatches(points_file, batch_rows):
+            edm.write(points)
+    return edm.count
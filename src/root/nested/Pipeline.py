@@ -0,0 +1,110 @@
+'''
+Overlapping disk I/O and sampling in Portfolio.distribute_locs.
+
+With pipeline=True, a background thread loads the next provinces' sampling
+tables (decoding clipped rasters when not cached) while the current province
+is sampled, and a writer thread drains finished batches to the output. The
+queues between stages hold at most PIPELINE_DEPTH items, which caps the
+tables and batches held in memory. GDAL reads, .npy reads and file writes
+release the GIL, so the stages overlap on network or spinning storage.
+'''
+
+import queue
+import threading
+
+# Items waiting between two stages
+PIPELINE_DEPTH = 2
+
+# End of a stage's stream
+_DONE = object()
+
+
+def _put(items, value, stop):
+    # Put on a bounded queue, giving up once the consumer has stopped
+    while not stop.is_set():
+        try:
+            items.put(value, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def prefetch(items, load, depth=PIPELINE_DEPTH):
+    '''
+    Yield (item, load(item)) in order, with load run in a background thread
+    up to depth items ahead. An exception raised by load is re-raised here.
+    '''
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def run():
+        for item in items:
+            try:
+                result = (item, load(item), None)
+            except BaseException as e:
+                result = (item, None, e)
+            if not _put(results, result, stop) or result[2] is not None:
+                return
+        _put(results, _DONE, stop)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result = results.get()
+            if result is _DONE:
+                return
+            item, loaded, error = result
+            if error is not None:
+                raise error
+            yield item, loaded
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundWriter(object):
+    '''
+    Call write(batch) for each batch put, in order, in a background thread.
+    put blocks while depth batches are waiting. The first exception raised
+    by write is re-raised by the next put or by close; later batches are
+    dropped.
+    '''
+
+    def __init__(self, write, depth=PIPELINE_DEPTH):
+        self.write = write
+        self.batches = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            batch = self.batches.get()
+            if batch is _DONE:
+                return
+            if self.error is None:
+                try:
+                    self.write(batch)
+                except BaseException as e:
+                    self.error = e
+
+    def put(self, batch):
+        if self.error is not None:
+            raise self.error
+        self.batches.put(batch)
+
+    def close(self, raise_error=True):
+        # Wait for waiting batches to be written. raise_error=False while another
+        # exception is being handled, so the writer's error does not hide it.
+        self.batches.put(_DONE)
+        self.thread.join()
+        if self.error is not None and raise_error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close(raise_error=exc[0] is None)
@@ -0,0 +1,153 @@
+'''
+Streaming writers for generated exposure points.
+
+Each province's batch is appended to one compiled output as soon as it is
+produced, so no per-province files need to be merged afterwards. Output is
+either .csv or a compact binary .npy of structured records.
+'''
+
+import numpy as np
+import pandas
+import json
+import os
+import struct
+
+
+class CSVPointWriter(object):
+    '''
+    Write batches of locations (pandas DataFrames) to a single .csv file
+    '''
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(path, 'w', newline='')
+        pandas.DataFrame(columns=self.columns).to_csv(self.file, index=False)
+
+    def write(self, locdist_pandas):
+        locdist_pandas.to_csv(self.file, columns=self.columns, header=False, index=False)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Columns stored as dictionary codes in binary output, with the code tables
+# kept in a .codes.json file next to the points
+CODED_COLUMNS = ('State/Province', 'PostalCode', 'Country', 'LOB', 'Peril')
+
+# Binary column types, everything else is a float64 value column
+COLUMN_TYPES = {'Realization': '<u4'}
+for column in CODED_COLUMNS:
+    COLUMN_TYPES[column] = '<u2'
+COLUMN_TYPES['PostalCode'] = '<u4'
+
+
+def pointDtype(columns):
+    # Structured record type for a list of output columns
+    return np.dtype([(column, COLUMN_TYPES.get(column, '<f8')) for column in columns])
+
+
+def codesFile(path):
+    return '%s.codes.json' % os.path.splitext(path)[0]
+
+
+class NpyPointWriter(object):
+    '''
+    Write batches of locations to a single .npy file of structured records,
+    readable memory-mapped with np.load(path, mmap_mode='r'). Text columns
+    are dictionary-encoded.
+    '''
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.dtype = pointDtype(self.columns)
+        self.count = 0
+        self.codes = dict((column, {}) for column in self.columns if column in CODED_COLUMNS)
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(path, 'wb')
+
+        # Reserve room for a header big enough for any record count, rewritten on close
+        self.headerLength = len(self.header(10**19))
+        self.file.write(b'\0' * self.headerLength)
+
+    def header(self, count, length=None):
+        # .npy format version 1.0 header for count records
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(self.dtype), count)
+        if length is None:
+            length = 10 + len(header) + 1
+            length += -length % 64
+        header = header + ' ' * (length - 10 - len(header) - 1) + '\n'
+        return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1')
+
+    def encode(self, column, values):
+        # Dictionary codes for a column of names, new names are appended to the table
+        codes = self.codes[column]
+        names, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        lookup = np.array([codes.setdefault(name, len(codes)) for name in names.tolist()], dtype=self.dtype[column])
+        return lookup[inverse]
+
+    def write(self, locdist_pandas):
+        records = np.empty(len(locdist_pandas), dtype=self.dtype)
+        for column in self.columns:
+            if column in self.codes:
+                records[column] = self.encode(column, locdist_pandas[column])
+            else:
+                records[column] = locdist_pandas[column]
+        self.file.write(records.tobytes())
+        self.count += len(records)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(self.header(self.count, self.headerLength))
+        self.file.close()
+
+        tables = dict((column, sorted(codes, key=codes.get)) for column, codes in self.codes.items())
+        with open(codesFile(self.path), 'w') as codefile:
+            json.dump(tables, codefile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Output formats selectable in Portfolio
+WRITERS = {'csv': CSVPointWriter,
+           'npy': NpyPointWriter}
+
+
+def readPoints(path):
+    '''
+    Memory-map a binary points file. Returns the structured records and the
+    code tables, e.g. codes['Country'][records['Country']] gives country names.
+    '''
+    records = np.load(path, mmap_mode='r')
+    with open(codesFile(path), 'r') as codefile:
+        codes = dict((column, np.array(names, dtype=object)) for column, names in json.load(codefile).items())
+    return records, codes
+
+
+def exportCSV(path, csv_path, chunksize=1000000):
+    # Export a binary points file to .csv, chunk by chunk
+    records, codes = readPoints(path)
+    columns = list(records.dtype.names)
+    with CSVPointWriter(csv_path, columns) as writer:
+        for start in range(0, len(records), chunksize):
+            chunk = records[start:start+chunksize]
+            locdist_pandas = pandas.DataFrame(dict((column, codes[column][chunk[column]] if column in codes else chunk[column]) for column in columns), columns=columns)
+            writer.write(locdist_pandas)
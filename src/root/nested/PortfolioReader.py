@@ -0,0 +1,82 @@
+'''
+Streaming portfolio ingestion.
+
+Portfolio files have one row per region: name (province or postal code),
+location count and total TIV, optionally with a LOB column. Extracts at
+sub-province and LOB granularity run to hundreds of thousands of rows, so
+the file is read in chunks, counts and TIVs are parsed as numbers by the
+CSV reader (thousands separators included), and each chunk is summed per
+region for the portfolio's LOB before the next one is read. Only the region
+totals are kept.
+'''
+
+import numpy as np
+import pandas
+
+# Rows of a portfolio file read at a time
+CHUNK_ROWS = 100000
+
+# Optional line of business column, rows of other LOBs are skipped
+LOB_COLUMN = 'LOB'
+
+# Columns of the aggregated portfolio, indexed by region name
+TOTAL_COLUMNS = ['locCount', 'locTIV']
+
+
+def parseNumbers(values):
+    # Numeric column, cleaning values the reader left as text (quoted or padded numbers)
+    if values.dtype.kind in 'iuf':
+        return values.astype(np.float64)
+    return pandas.to_numeric(values.astype(str).str.replace(',', '', regex=False).str.strip(), errors='coerce')
+
+
+def aggregateChunk(chunk, LOB=None):
+    '''
+    Region totals of a block of portfolio rows (name, count, TIV[, LOB]) as
+    a DataFrame indexed by name. Rows with unreadable numbers are reported
+    and dropped.
+    '''
+    if LOB is not None and LOB_COLUMN in chunk.columns[3:]:
+        chunk = chunk[chunk[LOB_COLUMN].astype(str).str.strip() == LOB]
+    names = chunk.iloc[:,0].astype(object)
+    named = names.notna()
+    names[named] = names[named].astype(str).str.strip()
+    totals = pandas.DataFrame({'locCount': parseNumbers(chunk.iloc[:,1]), 'locTIV': parseNumbers(chunk.iloc[:,2])})
+    totals.index = names.values
+    invalid = totals.isna().any(axis=1) & named.values
+    if invalid.any():
+        print("Invalid count or TIV for: ", list(totals.index[invalid]))
+    return totals[~invalid].groupby(level=0, sort=False).sum()
+
+
+def mergeTotals(totals, chunk_totals):
+    # Sum region totals, regions kept in order of first appearance
+    if totals is None:
+        return chunk_totals
+    return pandas.concat([totals, chunk_totals]).groupby(level=0, sort=False).sum()
+
+
+def readPortfolio(portfolio_file, LOB=None, chunk_rows=CHUNK_ROWS):
+    '''
+    Region totals of a portfolio .csv file, read chunk_rows rows at a time.
+    Region names are read as text, so postal codes keep leading zeros.
+    '''
+    header = pandas.read_csv(portfolio_file, sep=",", nrows=0, encoding='latin-1').columns
+    usecols = list(header[:3])
+    if LOB_COLUMN in header[3:]:
+        usecols.append(LOB_COLUMN)
+    totals = None
+    for chunk in pandas.read_csv(portfolio_file, sep=",", usecols=usecols, dtype={header[0]: str}, thousands=',',
+                                 encoding='latin-1', chunksize=chunk_rows):
+        totals = mergeTotals(totals, aggregateChunk(chunk[usecols], LOB))
+    if totals is None:
+        totals = pandas.DataFrame(columns=TOTAL_COLUMNS, dtype=np.float64)
+    return portfolioTotals(totals)
+
+
+def portfolioTotals(totals):
+    # Whole location counts, float TIVs
+    totals = totals[TOTAL_COLUMNS].copy()
+    totals['locCount'] = totals['locCount'].round().astype(np.int64)
+    totals['locTIV'] = totals['locTIV'].astype(np.float64)
+    return totals
@@ -0,0 +1,227 @@
+'''
+Postal code zones of a country.
+
+The postal code polygons of <country>/<country>PostalCodes.shp are
+rasterized once onto the country-level lights grid as a zone-id GeoTIFF
+(0 outside all zones, k for codes[k-1]). Point lookups are then a batched
+read of the zone raster, tile by tile, instead of point-in-polygon tests.
+
+Lit pixels of the country are also saved as one sampling table sorted by
+zone, with the pixels of zone k in tile_offsets[k-1]:tile_offsets[k], so
+postal-level portfolios are sampled zone by zone without per-zone files.
+'''
+
+from osgeo import gdal, ogr
+gdal.UseExceptions()
+import numpy as np
+import json
+import os
+import tempfile
+from root.nested.SamplingTable import SamplingTable, TABLE_VERSION, fileStamp, tiles
+
+# Postal code attribute of the zone polygons
+POSTAL_FIELD = 'postcode'
+
+# Locations sampled and written together, postal codes are grouped into jobs of about this size
+BATCH_LOCATIONS = 200000
+
+
+class PostalZones(object):
+    '''
+    Zone raster and zone-sorted sampling table of a country's postal codes
+    '''
+
+    def __init__(self, geodatafilepath, country, shp):
+        self.country = country
+        self.shp = shp
+        self.zone_file = os.path.join(geodatafilepath, country, '%sPostalZones.tif' % country)
+        self.meta_file = os.path.join(geodatafilepath, country, '%sPostalZones.json' % country)
+        self.tableName = '%s.postal' % country
+
+        # Codes and grid of the last build, None if not built
+        self.meta = None
+        try:
+            with open(self.meta_file, 'r') as metafile:
+                self.meta = json.load(metafile)
+        except (OSError, ValueError):
+            pass
+        self.setCodes()
+
+    def setCodes(self):
+        self.codes = self.meta['codes'] if self.meta else []
+        self.zone = dict((code, k) for k, code in enumerate(self.codes))
+
+    def available(self):
+        return self.meta is not None
+
+    def key(self, geoTrans, xsize, ysize):
+        return json.loads(json.dumps([TABLE_VERSION, geoTrans, xsize, ysize, fileStamp('%s.shp' % self.shp), fileStamp('%s.dbf' % self.shp)]))
+
+    def readZones(self):
+        # Postal code polygons grouped by code, codes sorted
+        driver = ogr.GetDriverByName("ESRI Shapefile")
+        shapef = driver.Open('%s.shp' % self.shp)
+        lyr = shapef.GetLayer()
+        geoms = []
+        for feature in lyr:
+            geom = feature.GetGeometryRef()
+            if geom is not None and geom.GetGeometryName() in ('POLYGON', 'MULTIPOLYGON'):
+                geoms.append((str(feature.GetField(POSTAL_FIELD)).strip(), geom.Clone()))
+        codes = sorted(set(code for code, geom in geoms))
+        label = dict((code, k+1) for k, code in enumerate(codes))
+        return codes, [geom for code, geom in geoms], [label[code] for code, geom in geoms]
+
+    def build(self, lights, window, mask_file=None):
+        '''
+        Rasterize zones over a window of a Clip's source image and save the
+        zone-sorted table to its TableStore. Skipped if already built for
+        this window and postal shapefile.
+        '''
+        xoff, yoff, xsize, ysize = window
+        geoTrans = lights.windowTransform(window)
+        key = self.key(geoTrans, xsize, ysize)
+        if self.meta is not None and self.meta['key'] == key and lights.tables.load(self.tableName) is not None:
+            return
+        if os.path.exists(self.meta_file):
+            os.remove(self.meta_file)
+        self.meta = None
+
+        codes, geoms, labels = self.readZones()
+        boxes = [lights.pixelBox(geoTrans, geom.GetEnvelope(), xsize, ysize) for geom in geoms]
+        dtype = gdal.GDT_UInt16 if len(codes) < 2**16 else gdal.GDT_UInt32
+        gtiffDriver = gdal.GetDriverByName( 'GTiff' )
+        ds = gtiffDriver.Create(self.zone_file, xsize, ysize, 1, dtype, options=['TILED=YES', 'COMPRESS=DEFLATE', 'SPARSE_OK=TRUE'])
+        ds.SetGeoTransform(geoTrans)
+        ds.SetProjection(lights.srcImage.GetProjection())
+        band = ds.GetRasterBand(1)
+
+        # Pass 1: burn zones tile by tile, counting lit pixels per zone
+        counts = np.zeros(len(codes)+1, dtype=np.int64)
+        for tile in tiles(xsize, ysize, lights.tile_size):
+            tx, ty, tw, th = tile
+            inside = [k for k, box in enumerate(boxes) if lights.overlaps(box, tile)]
+            if not inside:
+                continue
+            with lights.log.stage('postal zones', tile=list(tile), polygons=len(inside)):
+                zones = lights.rasterizeLabels([geoms[k] for k in inside], [labels[k] for k in inside], lights.offsetTransform(geoTrans, tx, ty), (tw, th))
+                band.WriteArray(zones, tx, ty)
+                values = lights.readTile(window, tile, mask_file)
+                counts += np.bincount(zones.ravel()[values > 0], minlength=len(codes)+1)
+        ds.FlushCache()
+        del band, ds
+
+        # Pass 2: lit pixels written to their zone's slot of the table
+        offsets = np.concatenate(([0], np.cumsum(counts[1:])))
+        total = int(offsets[-1])
+        with lights.log.stage('postal table', pixels=total), tempfile.TemporaryDirectory(dir=self.tablesDirectory(lights)) as tmpdir:
+            if total == 0:
+                table = SamplingTable(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32), (ysize, xsize), geoTrans, tile_offsets=offsets)
+            else:
+                index = np.memmap(os.path.join(tmpdir, 'index'), dtype=np.int64, mode='w+', shape=(total,))
+                weight = np.memmap(os.path.join(tmpdir, 'weight'), dtype=np.uint32, mode='w+', shape=(total,))
+                cursor = offsets[:-1].copy()
+                zone_band = gdal.Open(self.zone_file).GetRasterBand(1)
+                for tile in tiles(xsize, ysize, lights.tile_size):
+                    tx, ty, tw, th = tile
+                    zones = zone_band.ReadAsArray(tx, ty, tw, th).ravel()
+                    if not zones.any():
+                        continue
+                    values = lights.readTile(window, tile, mask_file)
+                    lit = np.flatnonzero((values > 0) & (zones > 0))
+                    lit = lit[np.argsort(zones[lit], kind='stable')]
+                    z = zones[lit].astype(np.int64) - 1
+
+                    # Slot of each pixel: next free position of its zone, plus its rank within the tile
+                    rank = np.arange(len(z)) - np.searchsorted(z, z, side='left')
+                    slots = cursor[z] + rank
+                    index[slots] = (ty + lit // tw) * xsize + tx + lit % tw
+                    weight[slots] = values[lit]
+                    cursor += np.bincount(z, minlength=len(codes))
+                del zone_band
+                index.flush()
+                weight.flush()
+                cumdist = np.memmap(os.path.join(tmpdir, 'cumdist'), dtype=np.int64, mode='w+', shape=(total,))
+                np.cumsum(weight, dtype=np.int64, out=cumdist)
+                table = SamplingTable(index, weight, (ysize, xsize), geoTrans, cumdist, offsets)
+            lights.tables.save(self.tableName, table)
+            del table
+            index = weight = cumdist = None
+
+        # Metadata is written last, so an interrupted build is redone
+        self.meta = {'key': key, 'codes': codes, 'geotransform': geoTrans, 'shape': [ysize, xsize]}
+        with open(self.meta_file, 'w') as metafile:
+            json.dump(self.meta, metafile)
+        self.setCodes()
+
+    def tablesDirectory(self, lights):
+        if not os.path.exists(lights.tables.directory):
+            os.makedirs(lights.tables.directory)
+        return lights.tables.directory
+
+    def zoneTable(self, table, code):
+        '''
+        Sampling table of one zone, sliced from the zone-sorted table
+        (raw or weight-transformed)
+        '''
+        k = self.zone[code]
+        start, end = table.tile_offsets[k], table.tile_offsets[k+1]
+        base = table.cumdist[start-1] if start > 0 else 0
+        return SamplingTable(np.asarray(table.index[start:end]), np.asarray(table.weight[start:end]), table.shape, table.geotransform,
+                             np.asarray(table.cumdist[start:end]) - base)
+
+    def zoneTotals(self, table, zones):
+        '''
+        First and end pixel of zones in the zone-sorted table, cumulative weight
+        before each zone and zone weights
+        '''
+        zones = np.asarray(zones, dtype=np.int64)
+        start, end = table.tile_offsets[zones], table.tile_offsets[zones+1]
+        before, last = np.zeros(len(zones)), np.zeros(len(zones))
+        before[start > 0] = table.cumdist[start[start > 0] - 1]
+        last[end > 0] = table.cumdist[end[end > 0] - 1]
+        return start, end, before, last - before
+
+    def sample(self, table, zones, counts, rng, realizations=1):
+        '''
+        Lit pixels for counts[i] locations in each of zones, all drawn with one
+        search of the zone-sorted table. Returned realization by realization,
+        zone by zone. Zones must have nonzero weight.
+        '''
+        start, end, before, total = self.zoneTotals(table, zones)
+        which = np.tile(np.repeat(np.arange(len(zones)), counts), realizations)
+        x = before[which] + rng.random(len(which)) * total[which]
+        pos = np.searchsorted(table.cumdist, x, side='right')
+        pos = np.minimum(np.maximum(pos, start[which]), end[which] - 1)
+        return np.asarray(table.index[pos])
+
+    def lookup(self, lat, lon, tile_size=1024):
+        '''
+        Postal codes of points, '' outside all zones. Points are grouped by
+        tile of the zone raster and each tile is read once.
+        '''
+        geoTrans = self.meta['geotransform']
+        ysize, xsize = self.meta['shape']
+        col = np.floor((np.asarray(lon, dtype=np.float64) - geoTrans[0]) / geoTrans[1]).astype(np.int64)
+        row = np.floor((np.asarray(lat, dtype=np.float64) - geoTrans[3]) / geoTrans[5]).astype(np.int64)
+        zones = np.zeros(np.size(col), dtype=np.int64)
+
+        inside = np.flatnonzero((col >= 0) & (col < xsize) & (row >= 0) & (row < ysize))
+        tile = (row[inside] // tile_size) * ((xsize + tile_size - 1) // tile_size) + col[inside] // tile_size
+        inside = inside[np.argsort(tile, kind='stable')]
+        tile = np.sort(tile, kind='stable')
+        starts = np.flatnonzero(np.concatenate(([True], tile[1:] != tile[:-1]))) if len(tile) else []
+        ends = np.append(starts[1:], len(tile)) if len(tile) else []
+
+        band = gdal.Open(self.zone_file).GetRasterBand(1)
+        for start, end in zip(starts, ends):
+            points = inside[start:end]
+            ty = (row[points[0]] // tile_size) * tile_size
+            tx = (col[points[0]] // tile_size) * tile_size
+            block = band.ReadAsArray(int(tx), int(ty), int(min(tile_size, xsize - tx)), int(min(tile_size, ysize - ty)))
+            zones[points] = block[row[points] - ty, col[points] - tx]
+        return np.array([''] + self.codes, dtype=object)[zones]
+
+    def lookupPixels(self, table, pixels):
+        # Postal codes of the lights pixels of a sampling table, by pixel centre
+        lat, lon = table.pixelCorners(np.asarray(pixels))
+        return self.lookup(lat + 0.5*table.geotransform[5], lon + 0.5*table.geotransform[1])
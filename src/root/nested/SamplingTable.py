@@ -0,0 +1,422 @@
+'''
+Sparse sampling tables for clipped nighttime lights rasters.
+
+Most pixels of a clipped province raster are zero (ocean, masked area outside
+the polygon, unlit land), so only the lit pixels are kept.
+'''
+
+from osgeo import gdal
+gdal.UseExceptions()
+import numpy as np
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# Bump when the table layout or clip procedure changes, invalidates all caches
+TABLE_VERSION = 2
+
+# Default memory budget of tiled raster processing, and the approximate bytes held
+# per tile pixel (source values, labels, masks and lit pixel indices)
+MEMORY_BUDGET = 256*1024**2
+BYTES_PER_PIXEL = 32
+
+
+def cumulative(weight):
+    '''
+    Return running totals of weights as a 64-bit array
+    '''
+    # cumulative([1,2,3,4,5]) --> 1 3 6 10 15
+    weight = np.asarray(weight)
+    if weight.dtype.kind == 'f':
+        return np.cumsum(weight, dtype=np.float64)
+    return np.cumsum(weight, dtype=np.int64)
+
+
+def tileSize(memory_budget=MEMORY_BUDGET):
+    # Side in pixels of square tiles processed within memory_budget bytes
+    return max(int(np.sqrt(memory_budget / BYTES_PER_PIXEL)), 1)
+
+
+def tiles(xsize, ysize, size):
+    '''
+    (xoff, yoff, width, height) of square tiles covering an xsize x ysize
+    raster, row by row
+    '''
+    for yoff in range(0, ysize, size):
+        for xoff in range(0, xsize, size):
+            yield xoff, yoff, min(size, xsize - xoff), min(size, ysize - yoff)
+
+
+class SamplingTable(object):
+    '''
+    Flat indices and radiance of the lit pixels of a raster, plus the
+    raster shape and geotransform needed to turn indices back into lat/lon.
+    Pixels are stored tile by tile; pixels of tile t are
+    tile_offsets[t]:tile_offsets[t+1].
+    '''
+
+    def __init__(self, index, weight, shape, geotransform, cumdist=None, tile_offsets=None):
+        self.index = index
+        self.weight = weight
+        self.shape = tuple(int(i) for i in shape)
+        self.geotransform = tuple(float(i) for i in geotransform)
+
+        # Weighted distribution over lit pixels only
+        if cumdist is None:
+            cumdist = cumulative(weight)
+        self.cumdist = cumdist
+
+        # Untiled tables are a single tile
+        if tile_offsets is None:
+            tile_offsets = [0, np.size(index)]
+        self.tile_offsets = np.asarray(tile_offsets, dtype=np.int64)
+
+    @classmethod
+    def fromArray(cls, array, geotransform):
+        # Keep nonzero pixels of a 2D light array
+        flat = np.ravel(array)
+        index = np.flatnonzero(flat > 0)
+        return cls(index.astype(np.int64), flat[index], np.shape(array), geotransform)
+
+    def total(self):
+        # Sum of all weights, 0 if no light data
+        if np.size(self.cumdist) == 0:
+            return 0
+        return self.cumdist[-1]
+
+    def tileTotals(self):
+        # Sum of weights in each tile, reading only the tile ends of the distribution
+        ends = np.zeros(len(self.tile_offsets), dtype=np.asarray(self.cumdist).dtype)
+        nonempty = self.tile_offsets > 0
+        ends[nonempty] = self.cumdist[self.tile_offsets[nonempty] - 1]
+        return np.diff(ends)
+
+    def nbytes(self):
+        return self.index.nbytes + self.weight.nbytes + self.cumdist.nbytes
+
+    def resident(self):
+        # Copy read into memory, so sampling does not wait on a memory-mapped file
+        return SamplingTable(np.array(self.index), np.array(self.weight), self.shape, self.geotransform,
+                             np.array(self.cumdist), self.tile_offsets)
+
+    def pixelCorners(self, pixels):
+        '''
+        Upper-left lat/lon of flat raster indices
+        '''
+        w = self.shape[1]
+        lat = (pixels // w)*self.geotransform[5] + self.geotransform[3]
+        lon = (pixels % w)*self.geotransform[1] + self.geotransform[0]
+        return lat, lon
+
+
+def sampleCDF(table, count, rng, realizations=1):
+    '''
+    One search of the cumulative distribution per location.
+    Cost grows with locations x log(lit pixels).
+    '''
+    x = rng.random(count*realizations) * table.total()
+    return table.index[np.searchsorted(table.cumdist, x, side='right')]
+
+
+def sampleMultinomial(table, count, rng, realizations=1):
+    '''
+    Allocate all locations across lit pixels in one multinomial draw over
+    the weights, then expand the per-pixel counts. Cost grows with lit pixels
+    plus locations, better for millions of locations in one region. One
+    realization is drawn at a time, so only one lit-pixel array of counts
+    is held.
+    '''
+    weight = np.asarray(table.weight, dtype=np.float64)
+    pvals = weight / weight.sum()
+    startpt = np.empty(count*realizations, dtype=np.int64)
+    for r in range(realizations):
+        startpt[r*count:(r+1)*count] = np.repeat(table.index, rng.multinomial(count, pvals))
+    return startpt
+
+
+def sampleTiled(table, count, rng, realizations=1):
+    '''
+    Two-stage draw: allocate locations to tiles by their total weight, then
+    search the cumulative distribution within each tile. Only the lit pixels
+    of tiles receiving locations are read, so memory-mapped tables of very
+    large countries are never paged in whole.
+    '''
+    totals = np.asarray(table.tileTotals(), dtype=np.float64)
+    counts = rng.multinomial(count, totals / totals.sum(), size=realizations)
+
+    # Realization and position of each location, grouped by tile
+    startpt = np.zeros((realizations, count), dtype=np.int64)
+    filled = np.zeros(realizations, dtype=np.int64)
+    for t in np.flatnonzero(counts.sum(axis=0)):
+        start, end = table.tile_offsets[t], table.tile_offsets[t+1]
+        cumdist = np.asarray(table.cumdist[start:end])
+        base = table.cumdist[start-1] if start > 0 else 0
+        x = base + rng.random(counts[:,t].sum()) * (cumdist[-1] - base)
+        pixels = np.asarray(table.index[start:end])[np.minimum(np.searchsorted(cumdist, x, side='right'), end-start-1)]
+        for r, n in zip(np.flatnonzero(counts[:,t]), counts[:,t][counts[:,t] > 0]):
+            startpt[r, filled[r]:filled[r]+n], pixels = pixels[:n], pixels[n:]
+            filled[r] += n
+    return startpt.ravel()
+
+
+# Pixel sampling strategies selectable in Portfolio. Each returns the flat pixel
+# index of count locations for every realization, realization by realization.
+SAMPLERS = {'cdf': sampleCDF,
+            'multinomial': sampleMultinomial,
+            'tiled': sampleTiled}
+
+
+def threshold(weight, level):
+    # Drop pixels dimmer than level, e.g. rural lighting for commercial lines
+    return np.where(weight >= level, weight, 0)
+
+
+def power(weight, exponent):
+    # Power-law scaling, exponents above 1 concentrate weight in bright centres
+    return np.power(weight, exponent, dtype=np.float64)
+
+
+def cap(weight, level):
+    # Saturation cap, flattens bright urban cores
+    return np.minimum(weight, level)
+
+
+# Vectorized weight transforms. A transform is a list of [name, parameter] steps
+# applied in turn to the radiance of the lit pixels.
+WEIGHT_TRANSFORMS = {'threshold': threshold,
+                     'power': power,
+                     'cap': cap}
+
+# Default weight transform per line of business: raw radiance for every LOB.
+# Transforms are opt-in per run, e.g. weight_transform=[['threshold', 10], ['power', 1.5]]
+LOB_TRANSFORMS = {'Res': [],
+                  'Com': [],
+                  'Ind': []}
+
+
+def transformWeights(weight, transform):
+    for name, param in transform:
+        weight = WEIGHT_TRANSFORMS[name](weight, param)
+    return weight
+
+
+def transformKey(transform):
+    # Short stable name of a weight transform, '' for raw weights
+    if not transform:
+        return ''
+    return hashlib.sha1(json.dumps([list(step) for step in transform]).encode('utf-8')).hexdigest()[:12]
+
+
+def fileStamp(path):
+    # Identify a file version by path, size and modification time
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return [path, None, None]
+    return [path, stat.st_size, stat.st_mtime]
+
+
+def tableKey(image_file, shapefiles, resolution):
+    '''
+    Cache key for sampling tables: source raster, boundary shapefiles and clip parameters
+    '''
+    stamps = [fileStamp(image_file)]
+    for shp in shapefiles:
+        stamps.append(fileStamp('%s.shp' % shp))
+        stamps.append(fileStamp('%s.dbf' % shp))
+    key = json.dumps([TABLE_VERSION, resolution, stamps])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+# One lock per table file in this process, held while a table is built, saved and reopened
+_TABLE_LOCKS = {}
+_TABLE_LOCKS_LOCK = threading.Lock()
+
+
+def tableLock(path):
+    with _TABLE_LOCKS_LOCK:
+        return _TABLE_LOCKS.setdefault(path, threading.Lock())
+
+
+class TableStore(object):
+    '''
+    Persistent cache of per-province sampling tables. Arrays are saved as .npy
+    files and reopened memory-mapped, so repeat runs skip raster decoding.
+    Entries written under a different key are stale and rebuilt on access.
+    get is safe to call from several threads.
+    '''
+    arrays = ('index', 'weight', 'cumdist')
+
+    def __init__(self, directory, key, loaded=None, tile_size=None):
+        self.directory = directory
+        self.key = key
+
+        # Tile side used when rebuilding tables from clipped rasters
+        if tile_size is None:
+            tile_size = tileSize()
+        self.tile_size = tile_size
+
+        # Tables already opened by this store, shared by every portfolio using it.
+        # Any mapping of province to table with an atomic get works, e.g. a size-bounded LRU cache.
+        if loaded is None:
+            loaded = {}
+        self.loaded = loaded
+
+    def __getstate__(self):
+        # Worker processes reopen tables from disk rather than receiving copies
+        state = self.__dict__.copy()
+        state['loaded'] = {}
+        return state
+
+    def path(self, province, suffix):
+        return os.path.join(self.directory, '%s.%s' % (province, suffix))
+
+    def load(self, province):
+        # Return cached table, or None if missing or stale
+        try:
+            with open(self.path(province, 'json'), 'r') as metafile:
+                meta = json.load(metafile)
+        except (OSError, ValueError):
+            return None
+        if meta.get('key') != self.key:
+            return None
+
+        data = {}
+        for name in self.arrays:
+            if meta['count'] == 0: # Empty files cannot be memory-mapped
+                data[name] = np.zeros(0, dtype=meta['dtypes'][name])
+            else:
+                data[name] = np.load(self.path(province, '%s.npy' % name), mmap_mode='r')
+        return SamplingTable(data['index'], data['weight'], meta['shape'], meta['geotransform'], data['cumdist'], meta['tile_offsets'])
+
+    def save(self, province, table):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        if os.path.exists(self.path(province, 'json')):
+            os.remove(self.path(province, 'json'))
+        for name in self.arrays:
+            # Written aside and swapped in, so processes mapping the old file keep reading it intact
+            tmp = self.path(province, '%s.npy.tmp' % name)
+            with open(tmp, 'wb') as arrayfile:
+                np.save(arrayfile, np.asarray(getattr(table, name)))
+            os.replace(tmp, self.path(province, '%s.npy' % name))
+
+        # Metadata is written last, so an interrupted save is seen as stale
+        meta = {'key': self.key,
+                'count': int(np.size(table.index)),
+                'dtypes': dict((name, np.asarray(getattr(table, name)).dtype.str) for name in self.arrays),
+                'shape': table.shape,
+                'geotransform': table.geotransform,
+                'tile_offsets': table.tile_offsets.tolist()}
+        tmp = self.path(province, 'json.tmp')
+        with open(tmp, 'w') as metafile:
+            json.dump(meta, metafile)
+        os.replace(tmp, self.path(province, 'json'))
+
+    def get(self, province, raster_file, transform=None):
+        '''
+        Cached table for province, rebuilt from clipped raster if missing or stale.
+        Tables with a weight transform applied are cached separately, one per transform.
+        Concurrent calls for the same table build it once.
+        '''
+        name = province
+        if transformKey(transform):
+            name = '%s.%s' % (province, transformKey(transform))
+        table = self.loaded.get(name)
+        if table is not None:
+            return table
+        with tableLock(self.path(name, 'json')):
+            table = self.loaded.get(name)
+            if table is not None:
+                return table
+            table = self.load(name)
+            if table is None and name != province:
+                table = self.transform(name, self.get(province, raster_file), transform)
+            elif table is None:
+                table = self.build(province, raster_file)
+            self.loaded[name] = table
+        return table
+
+    def build(self, province, raster_file):
+        # Read a clipped light image file one tile at a time into temporary files, save the
+        # table and reopen it. Only one tile of pixels is held in memory.
+        ds = gdal.Open(raster_file)
+        band = ds.GetRasterBand(1)
+        dtype = band.ReadAsArray(0, 0, 1, 1).dtype
+        builder = TableBuilder(self.directory, (ds.RasterYSize, ds.RasterXSize), ds.GetGeoTransform(), dtype)
+        for xoff, yoff, w, h in tiles(ds.RasterXSize, ds.RasterYSize, self.tile_size):
+            flat = band.ReadAsArray(xoff, yoff, w, h).ravel()
+            lit = np.flatnonzero(flat > 0)
+            builder.add((yoff + lit // w) * ds.RasterXSize + xoff + lit % w, flat[lit])
+        table = builder.table()
+        self.save(province, table)
+        del table
+        builder.close()
+        return self.load(province)
+
+    def transform(self, name, table, transform):
+        # Apply a weight transform tile by tile, save the result under name and reopen it.
+        # Pixels whose weight drops to zero are removed.
+        dtype = transformWeights(np.zeros(1, dtype=table.weight.dtype), transform).dtype
+        builder = TableBuilder(self.directory, table.shape, table.geotransform, dtype)
+        for start, end in zip(table.tile_offsets[:-1], table.tile_offsets[1:]):
+            weight = transformWeights(np.asarray(table.weight[start:end]), transform)
+            keep = weight > 0
+            builder.add(np.asarray(table.index[start:end])[keep], weight[keep])
+        transformed = builder.table()
+        self.save(name, transformed)
+        del transformed
+        builder.close()
+        return self.load(name)
+
+
+class TableBuilder(object):
+    '''
+    Accumulates the lit pixels of one sampling table tile by tile in temporary
+    files, so tables of very large provinces are never held in memory whole
+    '''
+
+    def __init__(self, directory, shape, geotransform, dtype=np.uint32):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.shape = shape
+        self.geotransform = geotransform
+        self.dtype = np.dtype(dtype)
+        self.files = {}
+        for name in ('index', 'weight', 'cumdist'):
+            fd, self.files[name] = tempfile.mkstemp(suffix='.%s' % name, dir=directory)
+            os.close(fd)
+        self.streams = dict((name, open(self.files[name], 'wb')) for name in ('index', 'weight'))
+        self.tile_offsets = [0]
+
+    def add(self, index, weight):
+        # Lit pixels of the next tile, possibly none
+        self.streams['index'].write(np.asarray(index, dtype=np.int64).tobytes())
+        self.streams['weight'].write(np.asarray(weight, dtype=self.dtype).tobytes())
+        self.tile_offsets.append(self.tile_offsets[-1] + len(index))
+
+    def table(self):
+        # Finished table, arrays memory-mapped from the temporary files
+        for stream in self.streams.values():
+            stream.close()
+        count = self.tile_offsets[-1]
+        if count == 0:
+            return SamplingTable(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=self.dtype), self.shape, self.geotransform, tile_offsets=self.tile_offsets)
+        index = np.memmap(self.files['index'], dtype=np.int64, mode='r', shape=(count,))
+        weight = np.memmap(self.files['weight'], dtype=self.dtype, mode='r', shape=(count,))
+        cumdist = np.memmap(self.files['cumdist'], dtype=cumulative(weight[:1]).dtype, mode='w+', shape=(count,))
+        np.cumsum(weight, dtype=cumdist.dtype, out=cumdist)
+        return SamplingTable(index, weight, self.shape, self.geotransform, cumdist, self.tile_offsets)
+
+    def close(self):
+        # Remove temporary files, once any table returned by table() is released
+        for stream in self.streams.values():
+            stream.close()
+        for path in self.files.values():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
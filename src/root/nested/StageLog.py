@@ -0,0 +1,146 @@
+'''
+Pipeline stage instrumentation.
+
+Clip and Portfolio time each stage (raster load, clip/rasterize, geotiff
+write, table build, sampling, TIV scaling, output write, merge) and append
+one JSON line per stage and province to a run report:
+
+{"run": "20140408-101500", "country": "Belgium", "LOB": "Res", "peril": "WS",
+ "stage": "sampling", "province": "Antwerp", "locations": 1000, "seconds": 0.012,
+ "rss": 183500800, "peak_rss": 201326592, "pid": 4242}
+
+rss is the resident set size at the end of the stage and peak_rss the
+process high-water mark so far; the first stage raising peak_rss is the one
+driving memory. Summarize a report with
+
+    python -m root.nested.StageLog report.jsonl
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import threading
+import time
+import pandas
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+def memoryUsage():
+    '''
+    (rss, peak_rss) of this process in bytes, None where unavailable
+    '''
+    rss = peak = None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        rss, peak = info.rss, getattr(info, 'peak_wset', None) # Peak only reported on Windows
+    if peak is None:
+        try:
+            with open('/proc/self/status', 'r') as status:
+                fields = dict(line.split(':', 1) for line in status if ':' in line)
+            rss, peak = int(fields['VmRSS'].split()[0])*1024, int(fields['VmHWM'].split()[0])*1024
+        except (OSError, KeyError, ValueError):
+            if resource is not None:
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    return rss, peak
+
+
+class StageLog(object):
+    '''
+    Appends stage records to report_file as JSON lines. Without a report
+    file stages are still timed but nothing is written. Worker processes
+    append to the same file, one write per line. Context fields (country,
+    LOB, ...) are added to every record.
+    '''
+
+    def __init__(self, report_file=None, run=None, **context):
+        self.report_file = report_file
+        if run is None:
+            run = time.strftime('%Y%m%d-%H%M%S')
+        self.run = run
+        self.context = context
+        self.lock = threading.Lock()
+
+    def bind(self, **context):
+        # Log to the same report and run, with more context fields
+        return StageLog(self.report_file, self.run, **dict(self.context, **context))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, province=None, **counts):
+        '''
+        Time a block as one stage. Yields the record, so pixel and location
+        counts known only inside the block can be added to it.
+        '''
+        record = {'stage': name, 'province': province}
+        record.update(counts)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.emit(record)
+
+    def emit(self, record):
+        # Write one finished record, adding memory usage and process id
+        if self.report_file is None:
+            return
+        record = dict(self.context, run=self.run, **record)
+        record['rss'], record['peak_rss'] = memoryUsage()
+        record['pid'] = os.getpid()
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            directory = os.path.dirname(self.report_file)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.report_file, 'a') as report:
+                report.write(line)
+
+
+def readReport(report_file, run=None):
+    # Stage records of a report as a DataFrame, optionally for one run
+    with open(report_file, 'r') as report:
+        records = [json.loads(line) for line in report if line.strip()]
+    frame = pandas.DataFrame(records)
+    if run is not None and len(frame):
+        frame = frame[frame['run'] == run]
+    return frame
+
+
+def summarize(report_file, run=None):
+    '''
+    Total seconds and maximum peak RSS per stage, and per province across
+    stages, slowest first
+    '''
+    frame = readReport(report_file, run)
+    stages = frame.groupby('stage').agg(seconds=('seconds', 'sum'), peak_rss=('peak_rss', 'max'), records=('seconds', 'size'))
+    provinces = frame.dropna(subset=['province']).groupby('province').agg(seconds=('seconds', 'sum'), peak_rss=('peak_rss', 'max'))
+    return stages.sort_values('seconds', ascending=False), provinces.sort_values('seconds', ascending=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a pipeline stage report')
+    parser.add_argument('report_file', help='JSON lines report written by Clip/Portfolio')
+    parser.add_argument('--run', help='Only records of this run id')
+    parser.add_argument('--top', type=int, default=20, help='Number of provinces to list')
+    args = parser.parse_args()
+    stages, provinces = summarize(args.report_file, args.run)
+    print(stages.to_string())
+    print()
+    print(provinces.head(args.top).to_string())
@@ -0,0 +1,31 @@
+'''
+Tests of the NumPy/pandas logic, run from the repository root with
+
+    python -m pytest tests
+
+GDAL is only needed for raster and shapefile I/O. Where it is not installed
+a placeholder osgeo package lets the modules import; anything calling GDAL
+then fails with AttributeError.
+'''
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+try:
+    import osgeo.gdal
+except ImportError:
+    class _Missing(types.ModuleType):
+        def UseExceptions(self):
+            pass
+
+        def __getattr__(self, name):
+            raise AttributeError('GDAL is not installed: osgeo.%s.%s' % (self.__name__, name))
+
+    osgeo = types.ModuleType('osgeo')
+    for name in ('gdal', 'ogr', 'osr', 'gdalnumeric'):
+        setattr(osgeo, name, _Missing(name))
+        sys.modules['osgeo.%s' % name] = getattr(osgeo, name)
+    sys.modules['osgeo'] = osgeo
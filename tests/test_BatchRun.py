@@ -0,0 +1,52 @@
+import os
+
+from root.nested import BatchRun
+from root.nested.BatchRun import expandJobs, outputFile, runBatch
+
+MANIFEST = {'image_file': 'lights.tif',
+            'jobs': [{'countries': ['Belgium', 'France'], 'resolution': 'State/Province',
+                      'LOB': ['Res', 'Com'], 'peril': ['WS'], 'count': 10, 'avg_TIV': 100.},
+                     {'countries': ['Belgium'], 'resolution': 'Postal Code',
+                      'LOB': ['Res'], 'peril': ['FL'], 'portfolio': 'BelgiumPostal.csv', 'output_format': 'npy'}]}
+
+
+def test_expandJobs_groups_by_country_and_resolution():
+    groups = expandJobs(MANIFEST)
+    assert sorted(groups) == [('Belgium', 'Postal Code'), ('Belgium', 'State/Province'), ('France', 'State/Province')]
+    assert [(job['LOB'], job['peril']) for job in groups[('Belgium', 'State/Province')]] == [('Res', 'WS'), ('Com', 'WS')]
+    assert groups[('Belgium', 'Postal Code')][0]['portfolio'] == 'BelgiumPostal.csv'
+
+
+def test_outputFile_is_separate_per_job():
+    groups = expandJobs(MANIFEST)
+    files = [outputFile('data', job) for jobs in groups.values() for job in jobs]
+    assert len(set(files)) == len(files)
+    assert outputFile('data', groups[('Belgium', 'Postal Code')][0]) == os.path.join('data', 'Belgium', 'Provinces', 'BelgiumPostalPts_Res_FL.npy')
+
+
+class FakePortfolio(object):
+    # Writes the locations and skips the regions set per LOB
+    results = {'Res': (10, ['Limburg']), 'Com': (0, ['Brussels'])}
+
+    def __init__(self, country, image_file, portfolio_file, resolution, LOB, peril, datapath, **options):
+        self.LOB = LOB
+        self.tables = None
+
+    def distribute_locs(self):
+        if self.LOB == 'Ind':
+            raise ValueError('bad portfolio')
+        return self.results[self.LOB]
+
+
+def test_runBatch_reports_empty_and_incomplete_jobs(monkeypatch, capsys):
+    monkeypatch.setattr(BatchRun, 'Portfolio', FakePortfolio)
+    manifest = {'image_file': 'lights.tif',
+                'jobs': [{'countries': ['Belgium'], 'resolution': 'State/Province', 'portfolio': 'Belgium.csv',
+                          'LOB': ['Res', 'Com', 'Ind'], 'peril': ['WS']}]}
+    failed = runBatch(manifest)
+    assert [job['LOB'] for job, error in failed] == ['Com', 'Ind']
+    assert 'No locations written' in failed[0][1] and 'Brussels' in failed[0][1]
+    assert 'ValueError: bad portfolio' in failed[1][1]
+    out = capsys.readouterr().out
+    assert 'Completed 1 jobs (1 with skipped regions), 2 failed' in out
+    assert 'Skipped regions: Belgium State/Province Res WS: Limburg' in out
@@ -0,0 +1,53 @@
+import json
+import os
+
+from root.nested.Boundaries import NameMatcher, normalizeName
+
+US_STATES = ['Washington', 'District of Columbia', 'Maine', 'Maryland', 'New York', 'North Carolina', 'South Carolina']
+
+
+def test_normalizeName():
+    assert normalizeName(u'  São-Paulo ') == 'sao paulo'
+
+
+def test_exact_and_normalized_match(tmp_path):
+    matcher = NameMatcher(US_STATES, str(tmp_path / 'aliases.json'))
+    assert matcher.match('Maine')[0] == 'Maine'
+    assert matcher.match('NEW-YORK')[0] == 'New York'
+    matcher.save()
+    with open(str(tmp_path / 'aliases.json'), 'r') as aliasfile:
+        assert json.load(aliasfile) == {'NEW-YORK': 'New York'}
+
+
+def test_single_fuzzy_candidate_is_ambiguous(tmp_path):
+    matcher = NameMatcher(US_STATES, str(tmp_path / 'aliases.json'))
+    match, candidates = matcher.match('Main')
+    assert match is None
+    assert 'Maine' in candidates
+    match, candidates = matcher.match('Washington DC')
+    assert match is None
+    assert 'Washington' in candidates
+
+
+def test_fuzzy_matches_are_not_saved(tmp_path):
+    alias_file = str(tmp_path / 'aliases.json')
+    matcher = NameMatcher(US_STATES, alias_file)
+    assert matcher.match('Distric of Columbia')[0] == 'District of Columbia'
+    matcher.save()
+    assert not os.path.exists(alias_file)
+
+
+def test_close_runner_up_is_ambiguous():
+    match, candidates = NameMatcher(US_STATES).match('Carolina')
+    assert match is None
+
+
+def test_confirmed_aliases_are_reused(tmp_path):
+    alias_file = str(tmp_path / 'aliases.json')
+    matcher = NameMatcher(US_STATES, alias_file)
+    matcher.confirm('Washington DC', 'District of Columbia')
+    matcher.confirm('Guam', 'None')
+    matcher.save()
+    matcher = NameMatcher(US_STATES, alias_file)
+    assert matcher.match('Washington DC')[0] == 'District of Columbia'
+    assert matcher.match('Guam')[0] == 'None'
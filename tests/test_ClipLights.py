@@ -0,0 +1,64 @@
+import concurrent.futures
+import os
+import warnings
+
+import numpy as np
+
+from root.nested.ClipLights import Portfolio, COUNTRY_CLIP, COUNTRY_REGION, _boundedMap
+from root.nested.PostalZones import PostalZones
+from root.nested.SamplingTable import SamplingTable
+from root.nested.StageLog import StageLog
+
+
+def portfolioAt(resolution, country='Guatemala', geodatafilepath='data'):
+    # Portfolio with only the attributes used for file naming
+    portfolio = Portfolio.__new__(Portfolio)
+    portfolio.resolution = resolution
+    portfolio.country = country
+    portfolio.geodatafilepath = geodatafilepath
+    return portfolio
+
+
+def test_country_clip_names_are_reserved():
+    assert COUNTRY_CLIP % 'Guatemala' != 'Guatemala'
+    assert COUNTRY_REGION % 'Guatemala' not in ('Guatemala', COUNTRY_CLIP % 'Guatemala')
+
+
+def test_province_named_after_country_keeps_its_own_clip():
+    country = portfolioAt('Country')
+    province = portfolioAt('State/Province')
+    assert country.clipName('Guatemala') == COUNTRY_REGION % 'Guatemala'
+    assert province.clipName('Guatemala') == 'Guatemala'
+    assert country.clipFile('Guatemala') != province.clipFile('Guatemala')
+    assert province.clipFile('Guatemala') == os.path.join('data', 'Guatemala', 'Provinces', 'Clip', 'Guatemala.tif')
+
+
+def test_boundedMap_keeps_depth_calls_in_flight():
+    submitted = []
+
+    class Executor(object):
+        def submit(self, fn, arg):
+            submitted.append(arg)
+            future = concurrent.futures.Future()
+            future.set_result(fn(arg))
+            return future
+
+    results = _boundedMap(Executor(), lambda x: x * 2, iter(range(10)), 3)
+    assert next(results) == 0
+    assert len(submitted) == 3
+    assert list(results) == [2 * x for x in range(1, 10)]
+
+
+def test_distributeProvince_without_locations(tmp_path):
+    portfolio = portfolioAt('State/Province', geodatafilepath=str(tmp_path))
+    portfolio.LOB, portfolio.peril = 'Res', 'WS'
+    portfolio.realizations, portfolio.strategy, portfolio.intermediate = 2, 'cdf', False
+    portfolio.log = StageLog()
+    portfolio.postal = PostalZones(str(tmp_path), 'Guatemala', 'GuatemalaPostalCodes')
+    table = SamplingTable.fromArray(np.ones((2, 2), dtype=np.uint32), (-92.0, 0.5, 0.0, 17.0, 0.0, -0.5))
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        points = portfolio.distributeProvince('Peten', 0, 1000., seed=1, table=table)
+        assert len(points) == 0
+        points = portfolio.distributeProvince('Peten', 3, 300., seed=1, table=table)
+    assert np.allclose(points.groupby('Realization')['TIV'].sum(), [300., 300.])
@@ -0,0 +1,135 @@
+import collections
+import json
+import os
+import pickle
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas
+
+from root.nested.Boundaries import provinceShapefile
+from root.nested.ClipLights import Portfolio
+from root.nested.DisaggregationService import TableCache, DisaggregationService, DisaggregationServer
+from root.nested.SamplingTable import SamplingTable, fileStamp
+
+GEOTRANSFORM = (4.0, 0.5, 0.0, 51.0, 0.0, -0.5)
+
+
+def table(pixels):
+    return SamplingTable(np.arange(pixels, dtype=np.int64), np.ones(pixels, dtype=np.uint32), (4, 4), GEOTRANSFORM)
+
+
+def test_cache_evicts_least_recently_used_over_byte_cap():
+    one = table(4).nbytes()
+    cache = TableCache(3 * one)
+    for name in 'abc':
+        cache.put(name, table(4))
+    assert cache.get('a') is not None # a is now the most recent
+    cache.put('d', table(4))
+    assert cache.get('b') is None
+    assert [cache.get(name) is not None for name in 'acd'] == [True, True, True]
+    assert cache.status() == {'tables': 3, 'nbytes': 3 * one, 'max_bytes': 3 * one}
+
+    # A table larger than the cap is kept on its own
+    cache.put('e', table(16))
+    assert cache.status()['tables'] == 1 and cache.get('e') is not None
+
+
+def test_cache_view_stores_resident_copies():
+    view = TableCache(1024**2).view(('Belgium', 'State/Province', 'k'))
+    view['Antwerp'] = table(4)
+    assert 'Antwerp' in view and 'Liege' not in view
+    assert view.get('Liege') is None
+    assert view['Antwerp'].index.tolist() == [0, 1, 2, 3]
+
+
+def belgium(directory):
+    # Country directory with a cached boundary catalog and clipped tables, no GDAL needed
+    os.makedirs(os.path.join(directory, 'Belgium'))
+    with open(os.path.join(directory, 'Belgium', 'BelgiumResolution.csv'), 'w') as resolution:
+        resolution.write('xres,yres\n0.5,0.5\n')
+    shp = provinceShapefile(directory, 'Belgium')
+    features = collections.OrderedDict([('Antwerp', (0, (4.0, 5.0, 50.0, 51.0), b'')), ('Liege', (1, (5.0, 6.0, 49.5, 50.5), b''))])
+    with open(os.path.join(directory, 'Belgium', '%s.catalog' % os.path.basename(shp)), 'wb') as catalog_file:
+        pickle.dump(([fileStamp('%s.shp' % shp), fileStamp('%s.dbf' % shp)], features), catalog_file)
+    image_file = os.path.join(directory, 'lights.tif')
+    with open(image_file, 'w') as image:
+        image.write('v1')
+    portfolio = Portfolio('Belgium', image_file, pandas.DataFrame([['Antwerp', 1, 1.]]), 'State/Province', 'Res', 'WS', directory, interactive=False)
+    portfolio.tables.save('Antwerp', table(4))
+    portfolio.tables.save('Liege', table(8))
+    return image_file
+
+
+def request(**fields):
+    body = {'country': 'Belgium', 'provinces': {'Antwerp': [10, 1000.], 'Liège': [5, 500.], 'Atlantis': [3, 300.]},
+            'LOB': 'Res', 'peril': 'WS', 'seed': 1}
+    body.update(fields)
+    return body
+
+
+def test_disaggregate_matches_names_and_reports_skipped(tmp_path):
+    directory = str(tmp_path)
+    service = DisaggregationService(belgium(directory), directory)
+    points, skipped = service.disaggregate(request())
+    assert skipped == ['Atlantis']
+    sums = points.groupby('State/Province')['TIV'].sum()
+    assert np.allclose(sums[['Antwerp', 'Liege']].values, [1000., 500.])
+    assert service.cache.status()['tables'] == 2
+
+
+def test_disaggregate_drops_provinces_without_locations(tmp_path):
+    directory = str(tmp_path)
+    service = DisaggregationService(belgium(directory), directory)
+    points, skipped = service.disaggregate(request(provinces={'Antwerp': [0, 1000.], 'Liege': [0, 0.]}))
+    assert len(points) == 0
+    assert skipped == ['Antwerp']
+
+
+def test_disaggregate_keys_cache_on_current_inputs(tmp_path):
+    directory = str(tmp_path)
+    image_file = belgium(directory)
+    service = DisaggregationService(image_file, directory)
+    service.disaggregate(request())
+
+    # Tables cached for the old raster are not served once it is replaced
+    with open(image_file, 'w') as image:
+        image.write('version 2')
+    points, skipped = service.disaggregate(request())
+    assert len(points) == 0
+    assert sorted(skipped) == ['Antwerp', 'Atlantis', 'Liege']
+
+
+def test_handler(tmp_path):
+    directory = str(tmp_path)
+    server = DisaggregationServer(('localhost', 0), DisaggregationService(belgium(directory), directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://localhost:%d' % server.server_address[1]
+
+    def post(body):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url + '/disaggregate', data=body)) as response:
+                return response.status, json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as error:
+            return error.code, json.loads(error.read().decode('utf-8'))
+
+    try:
+        code, body = post(json.dumps(request()).encode('utf-8'))
+        assert code == 200
+        assert len(body['data']) == 15 and 'State/Province' in body['columns'] and body['skipped'] == ['Atlantis']
+        assert post(json.dumps(request(country='Atlantis')).encode('utf-8'))[0] == 400
+        assert post(b'{not json')[0] == 400
+
+        with urllib.request.urlopen(url + '/status') as response:
+            assert json.loads(response.read().decode('utf-8'))['tables'] == 2
+        try:
+            urllib.request.urlopen(url + '/other')
+            assert False
+        except urllib.error.HTTPError as error:
+            assert error.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
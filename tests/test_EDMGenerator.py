@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import pandas
+import pytest
+
+from root.nested.EDMGenerator import EDM, exportPoints
+
+
+def points(realizations, count, tiv):
+    n = realizations * count
+    return pandas.DataFrame({'Lat': np.linspace(50., 51., n), 'Lon': np.linspace(4., 5., n), 'TIV': np.full(n, tiv),
+                             'State/Province': 'Antwerp', 'Country': 'Belgium', 'LOB': 'Res', 'Peril': 'WS',
+                             'Realization': np.repeat(np.arange(realizations), count)})
+
+
+def test_locations_map_points_to_edm_fields(tmp_path):
+    edm = EDM('Belgium', 'Com', 'EQ', str(tmp_path))
+    edm.count = 5
+    locations = edm.locations(points(2, 2, 10.))
+    edm.close()
+    assert locations['ACCNTNUM'].tolist() == ['Belgium_Com_EQ_0'] * 2 + ['Belgium_Com_EQ_1'] * 2
+    assert locations['LOCNUM'].tolist() == [6, 7, 8, 9]
+    assert locations['STATE'].tolist() == ['Antwerp'] * 4
+    assert 'POSTALCODE' not in locations.columns
+    assert (locations['OCCTYPE'] == 4).all() and (locations['EQCV1VAL'] == 10.).all()
+
+
+def test_write_totals_accounts_across_batches(tmp_path):
+    directory = str(tmp_path / 'EDM')
+    with EDM('Belgium', 'Res', 'WS', directory) as edm:
+        edm.write(points(2, 3, 10.))
+        edm.write(points(2, 1, 5.))
+        edm.write(points(2, 0, 5.))
+    assert edm.count == 8
+    locations = pandas.read_csv(os.path.join(directory, 'Belgium_Res_WSLoc.csv'))
+    assert locations['LOCNUM'].tolist() == list(range(1, 9))
+    accounts = pandas.read_csv(os.path.join(directory, 'Belgium_Res_WSAcc.csv'))
+    assert accounts['ACCNTNUM'].tolist() == ['Belgium_Res_WS_0', 'Belgium_Res_WS_1']
+    assert accounts['BLANLIMAMT'].tolist() == [35., 35.]
+    assert (accounts['POLICYTYPE'] == 2).all()
+
+
+def test_exportPoints_reads_compiled_csv_in_batches(tmp_path):
+    points_file = str(tmp_path / 'points.csv')
+    points(1, 5, 2.).to_csv(points_file, index=False)
+    assert exportPoints(points_file, 'Belgium', 'Ind', 'FL', str(tmp_path / 'EDM'), batch_rows=2) == 5
+    accounts = pandas.read_csv(str(tmp_path / 'EDM' / 'Belgium_Ind_FLAcc.csv'))
+    assert accounts['BLANLIMAMT'].tolist() == [10.]
+
+
+def test_unknown_LOB_or_peril(tmp_path):
+    with pytest.raises(ValueError):
+        EDM('Belgium', 'Agr', 'WS', str(tmp_path))
+    with pytest.raises(ValueError):
+        EDM('Belgium', 'Res', 'HL', str(tmp_path))
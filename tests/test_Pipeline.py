@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+from root.nested.Pipeline import prefetch, BackgroundWriter
+
+
+def test_prefetch_keeps_order():
+    assert list(prefetch(range(6), lambda i: i*i, depth=2)) == [(i, i*i) for i in range(6)]
+
+
+def test_prefetch_bounds_items_ahead():
+    loaded = []
+    items = prefetch(range(20), lambda i: loaded.append(i) or i, depth=2)
+    next(items)
+    time.sleep(0.2)
+    # One consumed, depth waiting and one held by the loader
+    assert len(loaded) <= 4
+    items.close()
+
+
+def test_prefetch_reraises_load_errors():
+    def load(i):
+        if i == 3:
+            raise ValueError('bad raster')
+        return i
+    seen = []
+    with pytest.raises(ValueError):
+        for item, value in prefetch(range(10), load):
+            seen.append(item)
+    assert seen == [0, 1, 2]
+
+
+def test_prefetch_stops_loader_when_consumer_stops():
+    before = threading.active_count()
+    for item, value in prefetch(range(1000), lambda i: i, depth=1):
+        if item == 2:
+            break
+    assert threading.active_count() == before
+
+
+def test_writer_writes_in_order():
+    written = []
+    with BackgroundWriter(lambda batch: (time.sleep(0.001), written.append(batch)), depth=2) as writer:
+        for i in range(20):
+            writer.put(i)
+    assert written == list(range(20))
+
+
+def test_writer_error_raised_by_put_or_close():
+    def write(batch):
+        if batch == 2:
+            raise IOError('disk full')
+    writer = BackgroundWriter(write, depth=1)
+    with pytest.raises(IOError):
+        for i in range(100):
+            writer.put(i)
+        writer.close()
+
+
+def test_writer_error_does_not_hide_original():
+    def write(batch):
+        raise IOError('disk full')
+    with pytest.raises(KeyError):
+        with BackgroundWriter(write) as writer:
+            writer.put(1)
+            time.sleep(0.05)
+            raise KeyError('sampling failed')
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas
+
+from root.nested.PointWriter import CSVPointWriter, NpyPointWriter, readPoints, exportCSV
+
+COLUMNS = ['Lat', 'Lon', 'TIV', 'State/Province', 'PostalCode', 'Country', 'LOB', 'Peril', 'Realization']
+
+
+def batch(province, n, realization=0):
+    return pandas.DataFrame({'Lat': np.linspace(50, 51, n), 'Lon': np.linspace(4, 5, n), 'TIV': np.full(n, 1000.0),
+                             'State/Province': province, 'PostalCode': ['%04d' % i for i in range(n)],
+                             'Country': 'Belgium', 'LOB': 'Res', 'Peril': 'WS', 'Realization': realization})[COLUMNS]
+
+
+def test_npy_round_trip(tmp_path):
+    path = str(tmp_path / 'points.npy')
+    with NpyPointWriter(path, COLUMNS) as writer:
+        writer.write(batch('Antwerp', 3))
+        writer.write(batch('Liege', 2, 1))
+        writer.write(batch('Namur', 0))
+    records, codes = readPoints(path)
+    assert isinstance(records, np.memmap)
+    assert len(records) == 5
+    assert list(records.dtype.names) == COLUMNS
+    assert codes['State/Province'][records['State/Province']].tolist() == ['Antwerp']*3 + ['Liege']*2
+    assert codes['PostalCode'][records['PostalCode']].tolist() == ['0000', '0001', '0002', '0000', '0001']
+    assert records['Realization'].tolist() == [0, 0, 0, 1, 1]
+    assert np.allclose(records['Lat'], np.concatenate((np.linspace(50, 51, 3), np.linspace(50, 51, 2))))
+
+
+def test_npy_loads_without_codes(tmp_path):
+    path = str(tmp_path / 'points.npy')
+    with NpyPointWriter(path, ['Lat', 'Lon', 'TIV']) as writer:
+        writer.write(batch('Antwerp', 4))
+    assert np.load(path).shape == (4,)
+
+
+def test_export_matches_csv_writer(tmp_path):
+    npy_path = str(tmp_path / 'points.npy')
+    csv_path = str(tmp_path / 'points.csv')
+    with NpyPointWriter(npy_path, COLUMNS) as writer, CSVPointWriter(csv_path, COLUMNS) as csv_writer:
+        for points in (batch('Antwerp', 3), batch('Liege', 2, 1)):
+            writer.write(points)
+            csv_writer.write(points)
+    exported = str(tmp_path / 'exported.csv')
+    exportCSV(npy_path, exported, chunksize=2)
+    read = dict(dtype={'PostalCode': str})
+    pandas.testing.assert_frame_equal(pandas.read_csv(exported, **read), pandas.read_csv(csv_path, **read))
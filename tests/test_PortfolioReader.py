@@ -0,0 +1,58 @@
+import numpy as np
+import pandas
+
+from root.nested.PortfolioReader import readPortfolio, aggregateChunk, portfolioTotals
+
+PORTFOLIO = '''name,locCount,locTIV,LOB
+Antwerp,"1,000","2,500,000.5",Res
+00123,5,10,Res
+Antwerp,3,7,Res
+Liege,bad,1,Res
+Antwerp,9,9,Com
+,1,1,Res
+'''
+
+
+def writePortfolio(tmp_path, text=PORTFOLIO):
+    path = tmp_path / 'portfolio.csv'
+    path.write_text(text)
+    return str(path)
+
+
+def test_thousands_and_chunks_are_summed(tmp_path):
+    totals = readPortfolio(writePortfolio(tmp_path), 'Res', chunk_rows=2)
+    assert list(totals.index) == ['Antwerp', '00123']
+    assert totals.loc['Antwerp', 'locCount'] == 1003
+    assert totals.loc['Antwerp', 'locTIV'] == 2500007.5
+    assert totals['locCount'].dtype == np.int64
+
+
+def test_lob_column_selects_rows(tmp_path):
+    totals = readPortfolio(writePortfolio(tmp_path), 'Com')
+    assert totals.to_dict('index') == {'Antwerp': {'locCount': 9, 'locTIV': 9.0}}
+
+
+def test_without_lob_column_all_rows_count(tmp_path):
+    text = 'name,locCount,locTIV\nA,1,10\nA,2,20\nB,"1,500",3\n'
+    totals = readPortfolio(writePortfolio(tmp_path, text), 'Res')
+    assert totals['locCount'].to_dict() == {'A': 3, 'B': 1500}
+
+
+def test_invalid_rows_are_dropped(tmp_path, capsys):
+    totals = readPortfolio(writePortfolio(tmp_path), 'Res')
+    assert 'Liege' not in totals.index
+    assert 'Liege' in capsys.readouterr().out
+
+
+def test_empty_portfolio(tmp_path):
+    totals = readPortfolio(writePortfolio(tmp_path, 'name,locCount,locTIV\n'))
+    assert len(totals) == 0
+    assert list(totals.columns) == ['locCount', 'locTIV']
+
+
+def test_dataframe_and_country_rows():
+    frame = pandas.DataFrame({'name': ['A', 'B', 'A'], 'locCount': [1, 2, 3], 'locTIV': ['1,000', '5', '2']})
+    totals = portfolioTotals(aggregateChunk(frame))
+    assert totals.to_dict('index') == {'A': {'locCount': 4, 'locTIV': 1002.0}, 'B': {'locCount': 2, 'locTIV': 5.0}}
+    country = portfolioTotals(aggregateChunk(pandas.DataFrame([['Belgium', 10, 2500.0]])))
+    assert country.loc['Belgium', 'locCount'] == 10
@@ -0,0 +1,94 @@
+import json
+import os
+
+import numpy as np
+
+from root.nested.ClipLights import Portfolio
+from root.nested.PostalZones import PostalZones
+from root.nested.SamplingTable import SamplingTable, TableStore
+from root.nested.StageLog import StageLog
+
+GEOTRANSFORM = (10.0, 0.5, 0.0, 50.0, 0.0, -0.5)
+CODES = ['01000', '02000', '03000', '04000']
+
+
+def zoneSortedTable():
+    # Pixels of each postal code in turn, the last code has no lit pixels
+    index = np.array([0, 1, 6, 9, 10, 15], dtype=np.int64)
+    weight = np.array([1, 4, 2, 8, 3, 2], dtype=np.uint32)
+    return SamplingTable(index, weight, (4, 4), GEOTRANSFORM, tile_offsets=[0, 2, 5, 6, 6])
+
+
+def postalZones(directory):
+    os.makedirs(os.path.join(directory, 'Test'))
+    with open(os.path.join(directory, 'Test', 'TestPostalZones.json'), 'w') as metafile:
+        json.dump({'key': None, 'codes': CODES, 'geotransform': GEOTRANSFORM, 'shape': [4, 4]}, metafile)
+    return PostalZones(directory, 'Test', 'TestPostal')
+
+
+def postalPortfolio(directory, weight_transform=None, realizations=1):
+    # Portfolio at Postal Code resolution with a saved zone table, no GDAL needed
+    portfolio = Portfolio.__new__(Portfolio)
+    portfolio.resolution = 'Postal Code'
+    portfolio.country = 'Test'
+    portfolio.LOB = 'Res'
+    portfolio.peril = 'WS'
+    portfolio.realizations = realizations
+    portfolio.weight_transform = weight_transform
+    portfolio.log = StageLog()
+    portfolio.postal = postalZones(directory)
+    portfolio.tables = TableStore(os.path.join(directory, 'tables'), 'k')
+    portfolio.tables.save(portfolio.postal.tableName, zoneSortedTable())
+    return portfolio
+
+
+def test_zoneTable_slices_one_code(tmp_path):
+    zones = postalZones(str(tmp_path))
+    zone = zones.zoneTable(zoneSortedTable(), '02000')
+    assert zone.index.tolist() == [6, 9, 10]
+    assert zone.cumdist.tolist() == [2, 10, 13]
+    assert zone.total() == 13
+    assert zones.zoneTable(zoneSortedTable(), '04000').total() == 0
+
+
+def test_sample_stays_within_zones(tmp_path):
+    zones = postalZones(str(tmp_path))
+    pixels = zones.sample(zoneSortedTable(), [0, 1, 2], [50, 60, 5], np.random.default_rng(1), realizations=2)
+    assert len(pixels) == 2 * 115
+    for r in range(2):
+        block = pixels[r*115:(r+1)*115]
+        assert set(block[:50]) <= {0, 1}
+        assert set(block[50:110]) <= {6, 9, 10}
+        assert set(block[110:]) == {15}
+
+
+def test_postalQC_drops_unknown_codes(tmp_path):
+    portfolio = postalPortfolio(str(tmp_path))
+    known, pairs = portfolio.postalQC(['01000', '99999', '03000'])
+    assert known == ['01000', '03000']
+    assert pairs == {'99999': 'None'}
+
+
+def test_postal_jobs_are_batched_in_zone_order(tmp_path, monkeypatch):
+    monkeypatch.setattr('root.nested.ClipLights.BATCH_LOCATIONS', 10)
+    portfolio = postalPortfolio(str(tmp_path), realizations=2)
+    cnt = {'03000': 2, '01000': 3, '02000': 4}
+    tiv = {'03000': 20., '01000': 30., '02000': 40.}
+    jobs = portfolio.postalJobs(['03000', '02000', '01000'], cnt, tiv)
+    assert jobs == [(['01000', '02000'], [3, 4], [30., 40.]), (['03000'], [2], [20.])]
+    assert portfolio.hasLights('01000') and not portfolio.hasLights('99999')
+
+
+def test_distributeZones_scales_TIV_per_code_and_realization(tmp_path):
+    portfolio = postalPortfolio(str(tmp_path), weight_transform=[['threshold', 5]], realizations=2)
+    points = portfolio.distributeZones(CODES, [3, 4, 2, 5], [30., 40., 20., 50.], seed=3)
+
+    # The last code has no lights; the third has no weight left after the transform and uses raw weights
+    assert len(points) == 2 * 9
+    assert set(points['PostalCode']) == {'01000', '02000', '03000'}
+    sums = points.groupby(['Realization', 'PostalCode'])['TIV'].sum()
+    for r in range(2):
+        assert np.allclose(sums[r].values, [30., 40., 20.])
+    assert (points['State/Province'] == points['PostalCode']).all()
+    lon = points['Lon'].values
+    assert ((lon > 10.0 - 0.5) & (lon < 12.0)).all()
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from root.nested.SamplingTable import SamplingTable, SAMPLERS
+
+GEOTRANSFORM = (10.0, 0.5, 0.0, 50.0, 0.0, -0.5)
+
+
+def tiledTable():
+    # Six lit pixels of a 4 x 4 raster in three tiles
+    index = np.array([0, 1, 6, 9, 10, 15], dtype=np.int64)
+    weight = np.array([1, 4, 2, 8, 3, 2], dtype=np.uint32)
+    return SamplingTable(index, weight, (4, 4), GEOTRANSFORM, tile_offsets=[0, 2, 5, 6])
+
+
+@pytest.mark.parametrize('strategy', sorted(SAMPLERS))
+def test_sampled_frequencies_match_weights(strategy):
+    table = tiledTable()
+    count, realizations = 20000, 3
+    startpt = SAMPLERS[strategy](table, count, np.random.default_rng(1), realizations)
+    assert np.shape(startpt) == (count*realizations,)
+    assert set(np.unique(startpt)) <= set(table.index.tolist())
+    expected = table.weight / table.weight.sum()
+    for r in range(realizations):
+        pixels = np.asarray(startpt[r*count:(r+1)*count])
+        observed = np.array([np.mean(pixels == i) for i in table.index])
+        assert np.allclose(observed, expected, atol=0.015)
+
+
+@pytest.mark.parametrize('strategy', sorted(SAMPLERS))
+def test_samplers_are_reproducible(strategy):
+    first = SAMPLERS[strategy](tiledTable(), 100, np.random.default_rng(7), 2)
+    second = SAMPLERS[strategy](tiledTable(), 100, np.random.default_rng(7), 2)
+    assert np.array_equal(first, second)
+
+
+def test_multinomial_realizations_are_independent():
+    startpt = SAMPLERS['multinomial'](tiledTable(), 1000, np.random.default_rng(3), 2)
+    assert not np.array_equal(np.bincount(startpt[:1000]), np.bincount(startpt[1000:]))
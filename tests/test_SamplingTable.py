@@ -0,0 +1,36 @@
+import numpy as np
+
+from root.nested.SamplingTable import SamplingTable, sampleCDF
+
+GEOTRANSFORM = (10.0, 0.5, 0.0, 50.0, 0.0, -0.5)
+
+
+def test_fromArray_keeps_lit_pixels():
+    lights = np.array([[0, 3, 0], [5, 0, 2]], dtype=np.uint32)
+    table = SamplingTable.fromArray(lights, GEOTRANSFORM)
+    assert table.index.tolist() == [1, 3, 5]
+    assert table.weight.tolist() == [3, 5, 2]
+    assert table.cumdist.tolist() == [3, 8, 10]
+    assert table.total() == 10
+    assert table.shape == (2, 3)
+    assert table.tile_offsets.tolist() == [0, 3]
+
+
+def test_empty_table_total():
+    table = SamplingTable.fromArray(np.zeros((2, 2), dtype=np.uint32), GEOTRANSFORM)
+    assert table.total() == 0
+    assert table.nbytes() == 0
+
+
+def test_pixelCorners():
+    table = SamplingTable.fromArray(np.ones((4, 4), dtype=np.uint32), GEOTRANSFORM)
+    lat, lon = table.pixelCorners(np.array([0, 6]))
+    assert np.allclose(lat, [50.0, 49.5])
+    assert np.allclose(lon, [10.0, 11.0])
+
+
+def test_cdf_sampling_only_draws_lit_pixels():
+    lights = np.array([[0, 1], [3, 0]], dtype=np.uint32)
+    startpt = sampleCDF(SamplingTable.fromArray(lights, GEOTRANSFORM), 40000, np.random.default_rng(0))
+    assert set(np.unique(startpt)) == {1, 2}
+    assert abs(np.mean(startpt == 2) - 0.75) < 0.01
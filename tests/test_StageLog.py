@@ -0,0 +1,51 @@
+import json
+import time
+
+import pytest
+
+from root.nested.StageLog import StageLog, readReport, summarize
+
+
+def test_stage_records_context_counts_and_time(tmp_path):
+    report_file = str(tmp_path / 'report.jsonl')
+    log = StageLog(report_file, run='r1', country='Belgium').bind(LOB='Res')
+    with log.stage('sampling', 'Antwerp', locations=10) as record:
+        record['pixels'] = 4
+        time.sleep(0.01)
+    with open(report_file, 'r') as report:
+        records = [json.loads(line) for line in report]
+    assert len(records) == 1
+    record = records[0]
+    assert (record['run'], record['country'], record['LOB'], record['stage'], record['province']) == ('r1', 'Belgium', 'Res', 'sampling', 'Antwerp')
+    assert (record['locations'], record['pixels']) == (10, 4)
+    assert record['seconds'] >= 0.01
+    assert 'peak_rss' in record and 'pid' in record
+
+
+def test_failed_stage_is_still_recorded(tmp_path):
+    report_file = str(tmp_path / 'report.jsonl')
+    log = StageLog(report_file, run='r1')
+    with pytest.raises(ValueError):
+        with log.stage('table load', 'Liege'):
+            raise ValueError('no table')
+    assert readReport(report_file)['stage'].tolist() == ['table load']
+
+
+def test_no_report_file_writes_nothing(tmp_path):
+    with StageLog().stage('merge') as record:
+        pass
+    assert 'seconds' in record
+
+
+def test_summarize_by_stage_and_province(tmp_path):
+    report_file = str(tmp_path / 'report.jsonl')
+    with open(report_file, 'w') as report:
+        for run, stage, province, seconds, peak in [('r1', 'sampling', 'Antwerp', 1.0, 100), ('r1', 'sampling', 'Liege', 3.0, 300),
+                                                    ('r1', 'output write', 'Liege', 0.5, 200), ('r1', 'merge', None, 0.25, 400),
+                                                    ('r2', 'sampling', 'Antwerp', 9.0, 900)]:
+            report.write(json.dumps({'run': run, 'stage': stage, 'province': province, 'seconds': seconds, 'peak_rss': peak}) + '\n')
+    stages, provinces = summarize(report_file, 'r1')
+    assert stages.index.tolist() == ['sampling', 'output write', 'merge']
+    assert stages.loc['sampling', 'seconds'] == 4.0 and stages.loc['sampling', 'records'] == 2
+    assert provinces.index.tolist() == ['Liege', 'Antwerp']
+    assert provinces.loc['Liege', 'seconds'] == 3.5 and provinces.loc['Liege', 'peak_rss'] == 300
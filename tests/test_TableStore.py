@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+
+from root.nested.SamplingTable import SamplingTable, TableStore, tableKey
+
+GEOTRANSFORM = (10.0, 0.5, 0.0, 50.0, 0.0, -0.5)
+
+
+def tiledTable():
+    index = np.array([0, 1, 6, 9, 10, 15], dtype=np.int64)
+    weight = np.array([1, 4, 2, 8, 3, 2], dtype=np.uint32)
+    return SamplingTable(index, weight, (4, 4), GEOTRANSFORM, tile_offsets=[0, 2, 5, 6])
+
+
+def test_store_round_trip_and_invalidation(tmp_path):
+    directory = str(tmp_path)
+    table = tiledTable()
+    TableStore(directory, 'a').save('P', table)
+
+    loaded = TableStore(directory, 'a').load('P')
+    assert isinstance(loaded.index, np.memmap)
+    assert np.array_equal(loaded.index, table.index)
+    assert np.array_equal(loaded.cumdist, table.cumdist)
+    assert loaded.tile_offsets.tolist() == [0, 2, 5, 6]
+    assert loaded.shape == (4, 4) and loaded.geotransform == GEOTRANSFORM
+
+    # Written under another key, or metadata missing after an interrupted save
+    assert TableStore(directory, 'b').load('P') is None
+    os.remove(os.path.join(directory, 'P.json'))
+    assert TableStore(directory, 'a').load('P') is None
+
+
+def test_save_leaves_mapped_arrays_intact(tmp_path):
+    store = TableStore(str(tmp_path), 'a')
+    store.save('P', tiledTable())
+    mapped = store.load('P')
+    store.save('P', SamplingTable.fromArray(np.ones((2, 2), dtype=np.uint32), GEOTRANSFORM))
+    assert mapped.index.tolist() == [0, 1, 6, 9, 10, 15]
+    assert store.load('P').index.tolist() == [0, 1, 2, 3]
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')]
+
+
+def test_store_saves_empty_tables(tmp_path):
+    store = TableStore(str(tmp_path), 'a')
+    store.save('Empty', SamplingTable(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32), (4, 4), GEOTRANSFORM))
+    assert store.load('Empty').total() == 0
+
+
+def test_get_caches_loaded_tables(tmp_path):
+    store = TableStore(str(tmp_path), 'a')
+    store.save('P', tiledTable())
+    table = store.get('P', None)
+    assert store.get('P', None) is table
+    assert 'P' in store.loaded
+
+
+def test_tableKey_changes_with_inputs(tmp_path):
+    image = tmp_path / 'lights.tif'
+    shp = tmp_path / 'Provinces'
+    image.write_bytes(b'1')
+    (tmp_path / 'Provinces.shp').write_bytes(b'1')
+    key = tableKey(str(image), [str(shp)], 'State/Province')
+    assert key == tableKey(str(image), [str(shp)], 'State/Province')
+    assert key != tableKey(str(image), [str(shp)], 'Country')
+    (tmp_path / 'Provinces.shp').write_bytes(b'12')
+    assert key != tableKey(str(image), [str(shp)], 'State/Province')
+
+
+class FakeRaster(object):
+    # Stands in for a GDAL dataset and band over a 2D array
+    def __init__(self, array):
+        self.array = array
+        self.RasterYSize, self.RasterXSize = array.shape
+
+    def GetRasterBand(self, band):
+        return self
+
+    def GetGeoTransform(self):
+        return GEOTRANSFORM
+
+    def ReadAsArray(self, xoff, yoff, w, h):
+        return self.array[yoff:yoff+h, xoff:xoff+w]
+
+
+def test_tables_are_built_tile_by_tile_on_disk(tmp_path, monkeypatch):
+    array = np.zeros((5, 7), dtype=np.float32)
+    array[0, 1], array[2, 6], array[3, 2], array[4, 4] = 1.5, 4., 2., 0.25
+    monkeypatch.setattr('root.nested.SamplingTable.gdal.Open', lambda raster_file: FakeRaster(array), raising=False)
+
+    store = TableStore(str(tmp_path), 'a', tile_size=3)
+    table = store.get('P', 'P.tif')
+    assert isinstance(table.index, np.memmap)
+    assert len(table.tile_offsets) == 7 # 3 x 2 tiles
+    order = np.argsort(table.index)
+    assert table.index[order].tolist() == [1, 20, 23, 32]
+    assert table.weight.dtype == np.float32
+    assert table.weight[order].tolist() == [1.5, 4., 2., 0.25]
+    assert table.total() == 7.75
+
+    # Only the saved table is left in the store directory
+    assert sorted(os.listdir(str(tmp_path))) == ['P.cumdist.npy', 'P.index.npy', 'P.json', 'P.weight.npy']
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+
+from root.nested.SamplingTable import SamplingTable, TableStore, LOB_TRANSFORMS, transformWeights, transformKey
+
+GEOTRANSFORM = (10.0, 0.5, 0.0, 50.0, 0.0, -0.5)
+
+
+def tiledTable():
+    index = np.array([0, 1, 6, 9, 10, 15], dtype=np.int64)
+    weight = np.array([1, 4, 2, 8, 3, 2], dtype=np.uint32)
+    return SamplingTable(index, weight, (4, 4), GEOTRANSFORM, tile_offsets=[0, 2, 5, 6])
+
+
+def test_transformWeights():
+    weight = np.array([2, 5, 20, 60], dtype=np.uint32)
+    assert transformWeights(weight, [['threshold', 5], ['cap', 40]]).tolist() == [0, 5, 20, 40]
+    assert np.allclose(transformWeights(weight, [['power', 2]]), weight.astype(float)**2)
+    assert transformWeights(weight, []) is weight
+
+
+def test_transformKey():
+    assert transformKey([]) == transformKey(None) == ''
+    assert transformKey([['power', 2]]) == transformKey([('power', 2)])
+    assert transformKey([['power', 2]]) != transformKey([['power', 3]])
+
+
+def test_lob_defaults_are_raw_weights():
+    assert all(transform == [] for transform in LOB_TRANSFORMS.values())
+
+
+def test_store_caches_transformed_tables_separately(tmp_path):
+    store = TableStore(str(tmp_path), 'a')
+    store.save('P', tiledTable())
+    raw = store.get('P', None)
+    transformed = store.get('P', None, [['threshold', 3]])
+    assert raw.total() == 20
+    assert transformed.index.tolist() == [1, 9, 10]
+    assert transformed.tile_offsets.tolist() == [0, 1, 3, 3]
+    assert store.get('P', None, [['threshold', 3]]) is transformed
+    assert len([name for name in os.listdir(str(tmp_path)) if name.endswith('.json')]) == 2